@@ -0,0 +1,238 @@
+import glob
+import io
+import os
+import time
+
+import torch
+
+try:
+    from transformers.pytorch_utils import Conv1D
+except ImportError:
+    from transformers.modeling_utils import Conv1D
+
+BACKENDS = ('eager', 'int8', 'compile', 'onnx')
+
+
+def conv1d_to_linear(model):
+    """Replace GPT-2 `Conv1D` layers with the equivalent `nn.Linear` ones,
+    so they are picked up by the dynamic quantization."""
+    for module in list(model.modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                in_features, out_features = child.weight.shape
+                linear = torch.nn.Linear(in_features, out_features)
+                linear.weight.data = child.weight.data.t().contiguous()
+                linear.bias.data = child.bias.data
+                setattr(module, child_name, linear)
+    return model
+
+
+def quantize_int8(model):
+    """Quantize the linear layers of the model to int8 dynamically, in place,
+    so the fp32 weights are freed instead of kept next to the int8 ones."""
+    model = conv1d_to_linear(model)
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def compile_model(model):
+    if not hasattr(torch, 'compile'):
+        raise ValueError("The 'compile' backend needs torch>=2.0")
+    return torch.compile(model, dynamic=True)
+
+
+class _FlatPastModel(torch.nn.Module):
+    """Model with `past_key_values` flattened to separate inputs and outputs for the ONNX export."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, position_ids, *past_flat):
+        past = tuple((past_flat[i], past_flat[i + 1]) for i in range(0, len(past_flat), 2))
+        outputs = self.model(input_ids, past_key_values=past, attention_mask=attention_mask,
+                             position_ids=position_ids, use_cache=True)
+        return (outputs[0][:, -1, :],) + tuple(t for layer in outputs[1] for t in layer)
+
+
+def export_onnx(model, onnx_path):
+    """Export the GPT-2 like model with `past_key_values` to ONNX."""
+    config = model.config
+    head_dim = config.n_embd // config.n_head
+    past_names = [f'past_{i}_{kv}' for i in range(config.n_layer) for kv in ('key', 'value')]
+    present_names = [f'present_{i}_{kv}' for i in range(config.n_layer) for kv in ('key', 'value')]
+    # Non-empty past and prompt, so the traced graph doesn't specialize on them
+    input_ids = torch.zeros((1, 2), dtype=torch.long)
+    attention_mask = torch.ones((1, 3), dtype=torch.long)
+    position_ids = torch.tensor([[1, 2]], dtype=torch.long)
+    past = [torch.zeros((1, config.n_head, 1, head_dim)) for _ in past_names]
+
+    dynamic_axes = {'input_ids': {0: 'batch', 1: 'sequence'},
+                    'attention_mask': {0: 'batch', 1: 'total_sequence'},
+                    'position_ids': {0: 'batch', 1: 'sequence'},
+                    'logits': {0: 'batch'}}
+    dynamic_axes.update({name: {0: 'batch', 2: 'past_sequence'} for name in past_names})
+    dynamic_axes.update({name: {0: 'batch', 2: 'total_sequence'} for name in present_names})
+    torch.onnx.export(_FlatPastModel(model).eval(), (input_ids, attention_mask, position_ids, *past), onnx_path,
+                      input_names=['input_ids', 'attention_mask', 'position_ids'] + past_names,
+                      output_names=['logits'] + present_names,
+                      dynamic_axes=dynamic_axes, opset_version=14, dynamo=False)
+
+
+def fingerprinted_path(path, fingerprint):
+    """`path` with the fingerprint of the checkpoint added to the file name."""
+    root, ext = os.path.splitext(path)
+    return f'{root}-{fingerprint[:16]}{ext}'
+
+
+def remove_stale_exports(path, keep):
+    """Remove the files exported from the previous checkpoints to `path`."""
+    root, ext = os.path.splitext(path)
+    for stale in glob.glob(glob.escape(root) + '-*' + ext) + [path]:
+        if stale != keep and os.path.isfile(stale):
+            print(f'[INFO] backend - removing the stale export {stale}')
+            os.remove(stale)
+
+
+class OnnxRunner:
+    """Runs the model exported to ONNX with ONNX Runtime.
+    Called the same way as the torch model by `ModelWrapper`."""
+
+    def __init__(self, model, onnx_path, fingerprint=None):
+        """
+        :param onnx_path: where to export the model
+        :param fingerprint: (optional) fingerprint of the checkpoint, added to the file name,
+        so the model is exported again when the checkpoint changes
+        """
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("Please install onnxruntime to use the 'onnx' backend.")
+        export_path = fingerprinted_path(onnx_path, fingerprint) if fingerprint is not None else onnx_path
+        if not os.path.exists(export_path):
+            print(f'[INFO] backend - exporting the model to {export_path}')
+            export_onnx(model, export_path)
+            if export_path != onnx_path:
+                remove_stale_exports(onnx_path, keep=export_path)
+        onnx_path = export_path
+        config = model.config
+        self.onnx_path = onnx_path
+        self.num_layers = config.n_layer
+        self.past_shape = (config.n_head, 0, config.n_embd // config.n_head)
+        self.session = onnxruntime.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
+
+    def __getstate__(self):
+        # The session is loaded again from the exported file in other processes
+        state = self.__dict__.copy()
+        state['session'] = None
+        return state
+
+    def __setstate__(self, state):
+        import onnxruntime
+
+        self.__dict__.update(state)
+        self.session = onnxruntime.InferenceSession(self.onnx_path, providers=['CPUExecutionProvider'])
+
+    def __call__(self, input_ids, past_key_values=None, attention_mask=None, position_ids=None, use_cache=True):
+        batch_size, seq_len = input_ids.shape
+        if past_key_values is None:
+            empty = torch.zeros((batch_size,) + self.past_shape)
+            past_key_values = [(empty, empty)] * self.num_layers
+        past_len = past_key_values[0][0].shape[-2]
+        if attention_mask is None:
+            attention_mask = torch.ones((batch_size, past_len + seq_len), dtype=torch.long)
+        if position_ids is None:
+            position_ids = torch.arange(past_len, past_len + seq_len).expand(batch_size, -1)
+
+        feeds = {'input_ids': input_ids, 'attention_mask': attention_mask, 'position_ids': position_ids}
+        for i, (key, value) in enumerate(past_key_values):
+            feeds[f'past_{i}_key'] = key
+            feeds[f'past_{i}_value'] = value
+        outputs = self.session.run(None, {name: t.contiguous().cpu().numpy() for name, t in feeds.items()})
+        # Back to the device of the inputs, as the torch model would return them
+        outputs = [torch.from_numpy(o).to(input_ids.device) for o in outputs]
+        presents = tuple((outputs[i], outputs[i + 1]) for i in range(1, len(outputs), 2))
+        return outputs[0][:, None, :], presents
+
+
+def prepare_backend(model, backend, onnx_path=None, fingerprint=None):
+    """Get the callable running the forward pass of the model on the chosen backend.
+
+    :param model: loaded torch model
+    :param backend: one of `BACKENDS`
+    :param onnx_path: where to keep the exported model for the 'onnx' backend
+    :param fingerprint: (optional) fingerprint of the checkpoint the exported model is tied to
+    """
+    if backend == 'eager':
+        return model
+    if backend == 'int8':
+        return quantize_int8(model)
+    if backend == 'compile':
+        return compile_model(model)
+    if backend == 'onnx':
+        return OnnxRunner(model, onnx_path, fingerprint)
+    raise ValueError(f'Unknown backend {backend}, should be one of: {", ".join(BACKENDS)}')
+
+
+def process_memory():
+    """Resident memory of this process in bytes or None if it's unknown (outside Linux)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def model_size(runner):
+    """Size of the weights used by the backend in bytes."""
+    if hasattr(runner, 'onnx_path'):
+        return os.path.getsize(runner.onnx_path)
+    buffer = io.BytesIO()
+    torch.save(runner.state_dict(), buffer)
+    return buffer.tell()
+
+
+def benchmark_backends(model_path, prompts, backends=BACKENDS, runs=5):
+    """Compare latency, weights size, memory of the process and drift of the next
+    token distribution of the backends against the eager fp32 model.
+
+    The memory is the growth of the resident memory of the process while the model is loaded,
+    it includes everything the backend keeps, unlike the size of the serialized weights.
+    """
+    import gc
+    import torch.nn.functional as F
+    from inference import ModelWrapper
+
+    reference = None
+    for backend in backends:
+        gc.collect()
+        rss = process_memory()
+        m = ModelWrapper(model_path, model_path, max_length=20, backend=backend)
+        gc.collect()
+        loaded = process_memory() - rss if rss is not None else None
+        logits = m.next_token_logits(prompts)
+        if reference is None:
+            reference = logits
+        m.generate_batch(prompts)  # Warm up
+        start = time.perf_counter()
+        for _ in range(runs):
+            m.generate_batch(prompts)
+        dt = (time.perf_counter() - start) / runs
+        kl = F.kl_div(F.log_softmax(logits, -1), F.log_softmax(reference, -1),
+                      reduction='batchmean', log_target=True)
+        top1 = (logits.argmax(-1) == reference.argmax(-1)).float().mean()
+        memory = f"{loaded / 2 ** 20:.1f} MB" if loaded is not None else "-"
+        print(f"\t{model_path} {backend}: {dt * 1000:.1f} ms per batch, "
+              f"weights {model_size(m.runner) / 2 ** 20:.1f} MB, process memory +{memory}, "
+              f"KL to eager {kl.item():.5f}, top-1 agreement {top1.item():.2f}")
+        del m
+        gc.collect()
+
+
+if __name__ == '__main__':
+    import sys
+
+    # python backends.py gpt2 gpt2-medium
+    promts = ["[QUESTION]", "[QUESTION] Why did the chicken cross the road?\n[ANSWER]",
+              "[QUESTION] How many programmers does it take to change a light bulb?\n[ANSWER]"]
+    for path in sys.argv[1:] or ['gpt2', 'gpt2-medium']:
+        benchmark_backends(path, promts)
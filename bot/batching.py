@@ -0,0 +1,105 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class BatchScheduler(threading.Thread):
+    """Collects concurrent requests to one model into micro-batches.
+
+    The batch is sent to the model as soon as it has `max_batch_size`
+    requests or the first request in it waited for `max_wait_ms`.
+    """
+
+    def __init__(self, process_batch, max_batch_size=8, max_wait_ms=20,
+                 max_concurrent_batches=1, name='BatchScheduler'):
+        """
+        :param process_batch: function taking the list of requests and
+        returning the list of results in the same order
+        :param max_batch_size: max number of requests in one batch
+        :param max_wait_ms: max time the request waits for the batch to fill
+        :param max_concurrent_batches: number of batches processed at once,
+        the next batch is collected only when one of them is finished
+        :param name: name of the worker thread
+        """
+        super().__init__(name=name, daemon=True)
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._slots = threading.Semaphore(max_concurrent_batches)
+        self._executor = None
+        if max_concurrent_batches > 1:
+            self._executor = ThreadPoolExecutor(max_concurrent_batches, thread_name_prefix=name)
+
+    def submit(self, request):
+        """Schedule the request.
+
+        :return: `Future` with the result of the request
+        """
+        future = Future()
+        self._queue.put((request, future))
+        return future
+
+    def stop(self):
+        self._queue.put(None)
+
+    def close(self, timeout=None):
+        """Process the queued requests, then stop the worker and wait for it.
+
+        :param timeout: (optional) max seconds to wait for the worker
+        """
+        self.stop()
+        self.join(timeout)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def _collect_batch(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                # Put the stop signal back to exit after this batch
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run_batch(self, batch):
+        requests = [request for request, _ in batch]
+        try:
+            results = self.process_batch(requests)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def _run_batch_in_slot(self, batch):
+        try:
+            self._run_batch(batch)
+        finally:
+            self._slots.release()
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            self._slots.acquire()
+            batch = self._collect_batch(item)
+            if self._executor is None:
+                self._run_batch_in_slot(batch)
+            else:
+                self._executor.submit(self._run_batch_in_slot, batch)
@@ -0,0 +1,65 @@
+import csv
+import os
+
+import numpy as np
+
+MAGIC = b'JOKES01\0'
+# Magic and the number of jokes
+HEADER_SIZE = 16
+
+
+def build_store(csv_path, store_path, format_joke):
+    """Write the jokes of the csv file to the compact store.
+
+    The store is the header, offsets of the jokes (int64, number of jokes + 1)
+    and the utf-8 encoded jokes one after another. The csv is read row by row,
+    so only the offsets are kept in memory.
+
+    :param format_joke: function taking the csv row dict and returning the joke text
+    """
+    offsets = [0]
+    tmp_path = store_path + '.tmp'
+    data_path = store_path + '.data'
+    with open(csv_path, newline='', encoding='utf-8') as f, open(data_path, 'wb') as data:
+        for row in csv.DictReader(f):
+            offsets.append(offsets[-1] + data.write(format_joke(row).encode('utf-8')))
+    with open(tmp_path, 'wb') as out, open(data_path, 'rb') as data:
+        out.write(MAGIC)
+        out.write(np.uint64(len(offsets) - 1).tobytes())
+        out.write(np.asarray(offsets, dtype=np.int64).tobytes())
+        while True:
+            chunk = data.read(1 << 20)
+            if not chunk:
+                break
+            out.write(chunk)
+    os.remove(data_path)
+    os.replace(tmp_path, store_path)
+
+
+class JokesStore:
+    """Read-only sequence of the joke texts kept in the store written by `build_store`."""
+
+    def __init__(self, store_path, mmap=True):
+        """
+        :param mmap: map the store to memory instead of reading it,
+        the pages are then loaded on access and shared between processes
+        """
+        if mmap:
+            self._buffer = np.memmap(store_path, dtype=np.uint8, mode='r')
+        else:
+            self._buffer = np.fromfile(store_path, dtype=np.uint8)
+        if self._buffer[:len(MAGIC)].tobytes() != MAGIC:
+            raise ValueError(f'{store_path} is not a jokes store')
+        count = int(self._buffer[len(MAGIC):HEADER_SIZE].view(np.uint64)[0])
+        self._data_start = HEADER_SIZE + 8 * (count + 1)
+        self._offsets = self._buffer[HEADER_SIZE:self._data_start].view(np.int64)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < len(self):
+            raise IndexError('joke index out of range')
+        start = self._data_start + int(self._offsets[idx])
+        end = self._data_start + int(self._offsets[idx + 1])
+        return self._buffer[start:end].tobytes().decode('utf-8')
@@ -1,4 +1,10 @@
+import hashlib
+import io
+import os
+import time
+
 import torch
+import torch.nn.functional as F
 
 from transformers import (
     CTRLLMHeadModel,
@@ -15,6 +21,9 @@ from transformers import (
     XLNetTokenizer,
 )
 
+from backends import prepare_backend
+from metrics import STAGE_SECONDS
+
 MODEL_CLASSES = {
     "gpt2": (GPT2LMHeadModel, GPT2Tokenizer),
     "ctrl": (CTRLLMHeadModel, CTRLTokenizer),
@@ -23,9 +32,63 @@ MODEL_CLASSES = {
     "transfo-xl": (TransfoXLLMHeadModel, TransfoXLTokenizer),
     "xlm": (XLMWithLMHeadModel, XLMTokenizer),
 }
+# Models taking GPT-2 style `past_key_values`, `attention_mask` and `position_ids`,
+# generated by the sampling loop of `ModelWrapper`. The others use `model.generate`.
+KV_CACHE_MODEL_TYPES = ("gpt2",)
+
+
+def load_state_dict(model_path):
+    """Load the `pytorch_model.bin` weights of the local model memory-mapped,
+    so they are read lazily instead of being unpickled into memory first.
+    `model.safetensors` weights are already loaded this way by `from_pretrained`.
+
+    :return: state dict or None to let `from_pretrained` load the weights
+    """
+    bin_path = os.path.join(model_path, 'pytorch_model.bin')
+    if os.path.isfile(bin_path) and not os.path.isfile(os.path.join(model_path, 'model.safetensors')):
+        return torch.load(bin_path, map_location='cpu', mmap=True, weights_only=True)
+    return None
+
+
+def checkpoint_fingerprint(model_path, *settings):
+    """Fingerprint of the checkpoint and the generation settings.
+
+    Local checkpoints are identified by the names, sizes and modification
+    times of their files, downloaded ones by their name.
+    """
+    digest = hashlib.sha1()
+    if os.path.isdir(model_path):
+        for name in sorted(os.listdir(model_path)):
+            path = os.path.join(model_path, name)
+            # The exported ONNX model is not a part of the checkpoint
+            if os.path.isfile(path) and not name.endswith('.onnx'):
+                stat = os.stat(path)
+                digest.update(f'{name}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    else:
+        digest.update(model_path.encode())
+    digest.update(repr(settings).encode())
+    return digest.hexdigest()
+
+
+def new_timings(tokenize=0.0):
+    """Seconds spent in the stages of the generation, see `metrics.STAGE_SECONDS`."""
+    return {'tokenize': tokenize, 'prefill': 0.0, 'generate': 0.0, 'decode': 0.0}
+
+
+def expand_past(past, batch_size):
+    """Expand the cached `past_key_values` of one sequence to the batch."""
+    return tuple(tuple(t.expand(batch_size, *t.shape[1:]) for t in layer) for layer in past)
+
+
+def select_past(past, indices):
+    """Keep only the given sequences of the batch in `past_key_values`."""
+    return tuple(tuple(t.index_select(0, indices) for t in layer) for layer in past)
 
 
 class ModelWrapper:
+    # Number of generation calls the model can serve at once
+    concurrency = 1
+
     def __init__(self, model_path, model_name,
                  device='cpu',
                  model_type='gpt2',
@@ -34,7 +97,19 @@ class ModelWrapper:
                  num_return_sequences=1,
                  repetition_penalty=1.0,
                  k=50,
-                 p=0.95,):
+                 p=0.95,
+                 prompt_prefixes=(),
+                 backend='eager',
+                 stop_texts=None,):
+        """
+        :param prompt_prefixes: texts most of the prompts start with,
+        their `past_key_values` are precomputed and reused by every generation
+        :param backend: how to run the model, one of `backends.BACKENDS`
+        :param stop_texts: (optional) dict of text to the number of times it
+        may appear in the prompt with the generated text, the sequence is
+        finished as soon as any of them appears more times.
+        Sequences are always finished by the end of sequence token.
+        """
         self.num_return_sequences = num_return_sequences
         self.repetition_penalty = repetition_penalty
         self.k = k
@@ -42,52 +117,337 @@ class ModelWrapper:
         self.temperature = temperature
         self.device = device = torch.device(device)
         self.max_length = max_length
+        self.stop_texts = stop_texts or dict()
+        self.kv_cache = model_type in KV_CACHE_MODEL_TYPES
+        if backend == 'onnx' and not self.kv_cache:
+            raise ValueError(f"The 'onnx' backend only supports {', '.join(KV_CACHE_MODEL_TYPES)} models")
         model_class, tokenizer_class = MODEL_CLASSES[model_type]
         self.tokenizer = tokenizer_class.from_pretrained(model_path)
-        self.model = model_class.from_pretrained(model_path)
+        self.model = model_class.from_pretrained(model_path, state_dict=load_state_dict(model_path))
         self.name = model_name
+        # Identifies the jokes generated by this model with these settings
+        self.fingerprint = checkpoint_fingerprint(
+            model_path, model_type, backend, max_length, temperature, repetition_penalty, k, p, self.stop_texts)
         self.model.to(device)
+        self.backend = backend
+        self.onnx_path = (os.path.join(model_path, 'model.onnx') if os.path.isdir(model_path)
+                          else model_name.replace('/', '_') + '.onnx')
+        # The ONNX export is tied to the weights only, not to the generation settings
+        self.checkpoint_fingerprint = checkpoint_fingerprint(model_path, model_type)
+        # int8 quantizes the model in place, so `model` is the quantized one
+        self.runner = prepare_backend(self.model, backend, self.onnx_path, self.checkpoint_fingerprint)
+        if backend == 'onnx':
+            # The weights are in the ONNX Runtime session, the fp32 torch model isn't used anymore
+            self.model = None
+        self.prefix_cache = dict()
+        for prefix in prompt_prefixes:
+            self.cache_prefix(prefix)
 
-    def __encode(self, text):
-        encoded_prompt = self.tokenizer.encode(
-            text, add_special_tokens=False, return_tensors="pt")
-        return encoded_prompt.to(self.device)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.backend == 'int8':
+            # Quantized once here and sent serialized, the quantized
+            # weights can't be shared with the spawned processes
+            buffer = io.BytesIO()
+            torch.save(self.runner, buffer)
+            state['runner'] = buffer.getvalue()
+            state['model'] = None
+        elif self.backend == 'compile':
+            # The compiled runner is rebuilt from the torch model in the other processes
+            state['runner'] = None
+        return state
 
-    def generate(self, beginning, num_return_sequences=None):
-        if num_return_sequences is None:
-            num_return_sequences = self.num_return_sequences
-        encoded_prompt = self.__encode(beginning)
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self.runner, bytes):
+            self.runner = self.model = torch.load(io.BytesIO(self.runner), weights_only=False)
+        elif self.runner is None:
+            self.runner = prepare_backend(self.model, self.backend, self.onnx_path, self.checkpoint_fingerprint)
+
+    def share_memory(self):
+        """Move the fp32 torch weights to the shared memory before sending the model to the
+        worker processes. The int8 and ONNX weights are sent serialized instead."""
+        if self.backend in ('eager', 'compile'):
+            self.model.share_memory()
+
+    def close(self):
+        """Nothing to release, the model runs in this process, see `ModelWorkerPool.close`."""
+        pass
+
+    def __pad_token_id(self):
+        if self.tokenizer._pad_token is None:
+            return self.tokenizer.eos_token_id
+        return self.tokenizer.pad_token_id
+
+    @torch.no_grad()
+    def cache_prefix(self, text):
+        """Precompute `past_key_values` of the prompt prefix.
+
+        The last token of the prefix is left out of the cache,
+        so every prompt feeds at least one token to the model.
+        """
+        ids = self.tokenizer.encode(text, add_special_tokens=False)
+        if len(ids) < 2 or not self.kv_cache:
+            return
+        input_ids = torch.tensor([ids[:-1]], dtype=torch.long, device=self.device)
+        past = self.__forward(input_ids, torch.ones_like(input_ids), None)[1]
+        self.prefix_cache[text] = (ids[:-1], past)
+
+    def __find_prefix(self, encoded):
+        """Find the longest cached prefix shared by all the encoded prompts.
+
+        :return: (prefix ids, past) or (empty list, None)
+        """
+        best_ids, best_past = [], None
+        for ids, past in self.prefix_cache.values():
+            if len(ids) > len(best_ids) and all(e[:len(ids)] == ids for e in encoded):
+                best_ids, best_past = ids, past
+        return best_ids, best_past
+
+    def __prepare_inputs(self, encoded):
+        """Left-pad the prompts, reusing the cached prefix if possible.
+
+        :return: (input_ids, attention_mask, past) where input_ids
+        are the whole padded prompts and past covers the cached prefix
+        """
+        prefix_ids, past = self.__find_prefix(encoded)
+        suffixes = [ids[len(prefix_ids):] for ids in encoded]
+        suffix_len = max(len(ids) for ids in suffixes)
+        pad_token_id = self.__pad_token_id()
+        input_ids = torch.tensor(
+            [prefix_ids + [pad_token_id] * (suffix_len - len(ids)) + ids for ids in suffixes],
+            dtype=torch.long, device=self.device)
+        attention_mask = torch.tensor(
+            [[1] * len(prefix_ids) + [0] * (suffix_len - len(ids)) + [1] * len(ids) for ids in suffixes],
+            dtype=torch.long, device=self.device)
+        if past is not None:
+            past = expand_past(past, len(encoded))
+        return input_ids, attention_mask, past
+
+    def __forward(self, input_ids, attention_mask, past):
+        """Run the model on the new tokens.
+
+        :param input_ids: tokens not covered by the past
+        :param attention_mask: mask for past and new tokens
+        :return: (logits of the last token, new past)
+        """
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        position_ids = position_ids[:, -input_ids.shape[1]:]
+        outputs = self.runner(input_ids, past_key_values=past, attention_mask=attention_mask,
+                             position_ids=position_ids, use_cache=True)
+        return outputs[0][:, -1, :], outputs[1]
+
+    def __sample(self, logits, history, history_mask):
+        """Sample next tokens with repetition penalty, temperature, top-k and top-p.
+
+        :param history: prompts with the tokens generated so far
+        :param history_mask: attention mask of the history, the padding isn't penalized
+        """
+        if self.repetition_penalty != 1.0:
+            seen = torch.zeros_like(logits, dtype=torch.long).scatter_reduce(
+                1, history, history_mask.long(), reduce='amax')
+            penalized = torch.where(logits < 0, logits * self.repetition_penalty, logits / self.repetition_penalty)
+            logits = torch.where(seen.bool(), penalized, logits)
+        if self.temperature != 1.0:
+            logits = logits / self.temperature
+        if self.k > 0:
+            kth_logit = torch.topk(logits, min(self.k, logits.shape[-1]))[0][..., -1, None]
+            logits = logits.masked_fill(logits < kth_logit, -float('inf'))
+        if self.p < 1.0:
+            sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+            cumulative_probs = F.softmax(sorted_logits, dim=-1).cumsum(dim=-1)
+            # Keep the first token above the threshold
+            sorted_to_remove = cumulative_probs > self.p
+            sorted_to_remove[..., 1:] = sorted_to_remove[..., :-1].clone()
+            sorted_to_remove[..., 0] = False
+            to_remove = sorted_to_remove.scatter(1, sorted_indices, sorted_to_remove)
+            logits = logits.masked_fill(to_remove, -float('inf'))
+        return torch.multinomial(F.softmax(logits, dim=-1), num_samples=1).squeeze(1)
+
+    def __is_finished(self, token, text):
+        if token == self.tokenizer.eos_token_id:
+            return True
+        return any(text.count(stop) > times for stop, times in self.stop_texts.items())
+
+    def __observe(self, timings, kind):
+        for stage, seconds in timings.items():
+            STAGE_SECONDS.observe(seconds, stage=stage, model=self.name, kind=kind)
+
+    @torch.no_grad()
+    def __iter_texts(self, encoded, timings):
+        """Sample up to `max_length` tokens for each of the encoded prompts.
+
+        Finished sequences are dropped from the batch, so the model
+        runs only on the sequences still being generated.
+
+        :param timings: dict the seconds spent in the prefill, generate
+        and decode stages are added to
+        :return: iterator over the steps, yields the list of
+        (prompt index, decoded prompt with the text generated so far)
+        for the sequences sampled at this step
+        """
+        start = time.perf_counter()
+        input_ids, attention_mask, past = self.__prepare_inputs(encoded)
+        cached_len = 0 if past is None else past[0][0].shape[-2]
+        logits, past = self.__forward(input_ids[:, cached_len:], attention_mask, past)
+        history = input_ids
+        # Prompt index of each sequence in the batch
+        rows = list(range(len(encoded)))
+        generated = [[] for _ in encoded]
+        timings['prefill'] += time.perf_counter() - start
+        for step in range(self.max_length):
+            start = time.perf_counter()
+            next_tokens = self.__sample(logits, history, attention_mask)
+            history = torch.cat([history, next_tokens[:, None]], dim=1)
+            texts, active = [], []
+            decode_start = time.perf_counter()
+            for i, (row, token) in enumerate(zip(rows, next_tokens.tolist())):
+                generated[row].append(token)
+                text = self.__decode(encoded[row], generated[row])
+                texts.append((row, text))
+                if not self.__is_finished(token, text):
+                    active.append(i)
+            timings['decode'] += time.perf_counter() - decode_start
+            timings['generate'] += decode_start - start
+            yield texts
+            if not active or step + 1 == self.max_length:
+                break
+            start = time.perf_counter()
+            if len(active) < len(rows):
+                active = torch.tensor(active, dtype=torch.long, device=self.device)
+                rows = [rows[i] for i in active.tolist()]
+                next_tokens = next_tokens.index_select(0, active)
+                history = history.index_select(0, active)
+                attention_mask = attention_mask.index_select(0, active)
+                past = select_past(past, active)
+            attention_mask = F.pad(attention_mask, (0, 1), value=1)
+            logits, past = self.__forward(next_tokens[:, None], attention_mask, past)
+            timings['generate'] += time.perf_counter() - start
+
+    def __generate_texts(self, encoded, callbacks=None, timings=None, kind='continue'):
+        """Generate the sequence for each of the encoded prompts.
+
+        :param callbacks: (optional) list with the function (or None)
+        for each prompt, called with the whole decoded text after every step
+        :param timings: (optional) dict with the seconds of the stages before the generation
+        :param kind: kind of the request in the metrics
+        :return: list of decoded prompts with generated text
+        """
+        timings = timings or new_timings()
+        result = [self.__decode(ids, []) for ids in encoded]
+        for texts in self.__iter_texts(encoded, timings):
+            for row, text in texts:
+                result[row] = text
+                if callbacks and callbacks[row] is not None:
+                    callbacks[row](text)
+        self.__observe(timings, kind)
+        return result
+
+    @torch.no_grad()
+    def next_token_logits(self, beginnings):
+        """Logits of the next token after each of the beginnings."""
+        encoded = [self.tokenizer.encode(text, add_special_tokens=False) for text in beginnings]
+        input_ids, attention_mask, past = self.__prepare_inputs(encoded)
+        cached_len = 0 if past is None else past[0][0].shape[-2]
+        return self.__forward(input_ids[:, cached_len:], attention_mask, past)[0]
+
+    def __decode(self, prompt_ids, generated_ids):
+        return self.tokenizer.decode(prompt_ids + generated_ids, clean_up_tokenization_spaces=True)
+
+    @torch.no_grad()
+    def __generate_with_model(self, encoded_prompt, num_return_sequences, timings, kind):
+        """Sample the sequences with `model.generate`, for the models
+        without GPT-2 style `past_key_values`. The stop texts aren't checked.
+        """
+        start = time.perf_counter()
+        input_ids = torch.tensor([encoded_prompt], dtype=torch.long, device=self.device)
         output_sequences = self.model.generate(
-            input_ids=encoded_prompt,
-            max_length=self.max_length + len(encoded_prompt[0]),
+            input_ids=input_ids,
+            max_length=self.max_length + input_ids.shape[1],
             temperature=self.temperature,
             top_k=self.k,
             top_p=self.p,
             repetition_penalty=self.repetition_penalty,
             do_sample=True,
             num_return_sequences=num_return_sequences,
+            pad_token_id=self.__pad_token_id(),
         )
+        decode_start = time.perf_counter()
+        result = [self.tokenizer.decode(ids, clean_up_tokenization_spaces=True) for ids in output_sequences.tolist()]
+        timings['generate'] += decode_start - start
+        timings['decode'] += time.perf_counter() - decode_start
+        self.__observe(timings, kind)
+        return result
+
+    def generate(self, beginning, num_return_sequences=None):
+        if num_return_sequences is None:
+            num_return_sequences = self.num_return_sequences
+        start = time.perf_counter()
+        encoded_prompt = self.tokenizer.encode(beginning, add_special_tokens=False)
+        timings = new_timings(time.perf_counter() - start)
+        if not self.kv_cache:
+            return self.__generate_with_model(encoded_prompt, num_return_sequences, timings, 'refill')
+        return self.__generate_texts([encoded_prompt] * num_return_sequences, timings=timings, kind='refill')
 
-        # Remove the batch dimension when returning multiple sequences
-        if len(output_sequences.shape) > 2:
-            output_sequences.squeeze_()
-        return [self.tokenizer.decode(j, clean_up_tokenization_spaces=True) for j in output_sequences]
+    def generate_batch(self, beginnings, callbacks=None):
+        """Generate one sequence for each of the beginnings in a single batch.
+
+        Prompts are left-padded to the same length and masked out
+        with the attention mask.
+
+        :param callbacks: (optional) list with the function (or None) for each
+        beginning, called with the text generated so far after every token.
+        Models without GPT-2 style `past_key_values` generate the beginnings
+        one by one and call it once with the whole text.
+        """
+        start = time.perf_counter()
+        encoded = [self.tokenizer.encode(text, add_special_tokens=False) for text in beginnings]
+        timings = new_timings(time.perf_counter() - start)
+        if not self.kv_cache:
+            result = list()
+            for i, ids in enumerate(encoded):
+                result += self.__generate_with_model(ids, 1, timings if i == 0 else new_timings(), 'continue')
+                if callbacks and callbacks[i] is not None:
+                    callbacks[i](result[-1])
+            return result
+        return self.__generate_texts(encoded, callbacks, timings)
+
+
+def benchmark_prefix_cache(model_path, prefix, question, num_return_sequences=16, max_length=40, runs=5):
+    """Compare the time of the buffer refill and of the continuation of the typed
+    question with and without the cached prompt prefix, generated as by the bot.
+
+    :param prefix: prompt of the refills, cached by the bot with `prompt_prefixes`
+    :param question: prompt of the continuation, `custom_promt` with the question
+    :param num_return_sequences: jokes generated by each refill
+    """
+    m = ModelWrapper(model_path, model_path, max_length=max_length)
+    cases = {
+        f'refill of {num_return_sequences}': lambda: m.generate(prefix, num_return_sequences),
+        'continuation': lambda: m.generate_batch([question]),
+    }
+    for cached in (False, True):
+        m.prefix_cache.clear()
+        if cached:
+            m.cache_prefix(prefix)
+        for case, run in cases.items():
+            run()  # Warm up
+            dt = 0.0
+            for i in range(runs):
+                # The same samples with and without the cache
+                torch.manual_seed(i)
+                start = time.perf_counter()
+                run()
+                dt += time.perf_counter() - start
+            print(f"\t{model_path} {case}, prefix cache={cached}: {dt / runs * 1000:.1f} ms per call")
 
 
 if __name__ == '__main__':
-    import datetime
-
-    total_time = datetime.datetime.now()
-    m = ModelWrapper(model_path='gpt2', device='cuda')
-    # Time test
-    # for i in range(10):
-    #     start = datetime.datetime.now()
-    #     m.generate("hello, world")
-    #     dt = datetime.datetime.now() - start
-    #     print("\t", dt)
-    # Batch processing test
-    res = m.generate("[QUESTION] ", num_return_sequences=4)
-    for j in res:
-        print(j)
-
-    print("Total time: ", datetime.datetime.now() - total_time)
+    import sys
+
+    # Refill and continuation time with and without the prefix cache, e.g.
+    # python inference.py gpt2 gpt2-medium
+    promt = "[QUESTION]"
+    question = "[QUESTION] Why did the chicken cross the road?\n[ANSWER]"
+    for path in sys.argv[1:] or ['gpt2', 'gpt2-medium']:
+        benchmark_prefix_cache(path, promt, question)
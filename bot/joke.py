@@ -1,4 +1,5 @@
 class Joke:
-    def __init__(self, text, id):
+    def __init__(self, text, id, generated_by=None):
         self.id = id
         self.text = text
+        self.generated_by = generated_by
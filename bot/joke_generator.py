@@ -2,38 +2,137 @@ import random
 import os
 import threading
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from itertools import cycle
 
-import pandas as pd
 import storage
-from inference import ModelWrapper
+from dataset_store import build_store, JokesStore
+from worker_pool import load_model
 from joke import Joke
+from metrics import (BUFFER_POPS, POOL_SIZE, QUEUE_DEPTH, RESPONSE_CACHE_LOOKUPS, RESPONSE_CACHE_SIZE,
+                     STAGE_SECONDS)
+from jokes_pool import JokesPool, BufferRefiller
+from batching import BatchScheduler
+from response_cache import ResponseCache
+from retrieval import RetrievalIndex
+from scheduling import SCHEDULERS
+from startup import StartupTimer
 
 from abc import ABC, abstractmethod
 
 
-def synchronized(func):
-    func.__lock__ = threading.Lock()
-
-    def synced_func(*args, **kws):
-        with func.__lock__:
-            return func(*args, **kws)
-
-    return synced_func
-
 class AbstractJokeGenerator(ABC):
-    """Abstract class for joke generation using `ModelWrapper`."""
+    """Abstract class for joke generation using `ModelWrapper`.
+
+    Every model has its own lock, refiller and batcher, so different
+    models generate in parallel while each model runs one call at a time.
+    The models are loaded in parallel, by default in the background,
+    `ready` is set once the jokes can be generated.
+    """
 
     default_promt_token = '[QUESTION]'
     answer_token = '[ANSWER]'
     custom_promt = f'{default_promt_token}{{}}\n{answer_token}'
     stop_token = '<|endoftext|>'
+    # Generation stops as soon as the joke ends or the second one begins
+    stop_texts = {stop_token: 0, default_promt_token: 1, answer_token: 1}
     POS_GRADE = 1
     NEG_GRADE = -1
 
-    def __init__(self, jokes_buffer_size):
+    def __init__(self, max_joke_len=40, jokes_buffer_size=16, jokes_buffer_low_watermark=4,
+                 jokes_buffer_wait=1.0, max_batch_size=8, max_batch_wait_ms=20, model_workers=1,
+                 model_backend='eager', model_device='cpu', response_cache_size=1024,
+                 response_cache_ttl=3600, response_cache_answers=4, background_startup=True,
+                 fallback_slo=0, stream_update_interval=1.0):
+        """
+        :param max_joke_len: max number of generated tokens
+        :param jokes_buffer_size: number of pre-generated jokes for each model
+        :param jokes_buffer_low_watermark: buffer size at which it's refilled
+        :param jokes_buffer_wait: seconds to wait for the refill of the empty buffer,
+        then the joke is generated on its own
+        :param max_batch_size: max number of prompts generated in one batch
+        :param max_batch_wait_ms: max time the prompt waits for the batch
+        :param model_workers: number of processes serving each model
+        :param model_backend: inference backend, see `backends.BACKENDS`
+        :param model_device: device to run the models on
+        :param response_cache_size: max number of cached prompts, 0 disables the cache
+        :param response_cache_ttl: seconds the answers to the prompt are cached
+        :param response_cache_answers: number of cached answers for each prompt
+        :param background_startup: load the models in the background,
+        otherwise the constructor returns once they are loaded.
+        The jokes buffers are always filled in the background
+        :param fallback_slo: seconds after which the answer to the promt is replaced
+        by the dataset joke with the most similar question, 0 to always wait for the model
+        :param stream_update_interval: min seconds between the `on_update` calls of `generate_joke`
+        """
         self.store = storage
+        self.max_joke_len = max_joke_len
         self.jokes_buffer_size = jokes_buffer_size
+        self.jokes_buffer_low_watermark = jokes_buffer_low_watermark
+        self.jokes_buffer_wait = jokes_buffer_wait
+        self.max_batch_size = max_batch_size
+        self.max_batch_wait_ms = max_batch_wait_ms
+        self.model_workers = model_workers
+        self.model_backend = model_backend
+        self.model_device = model_device
+        self.response_cache = None
+        if response_cache_size > 0:
+            self.response_cache = ResponseCache(response_cache_size, response_cache_ttl,
+                                                response_cache_answers)
+            RESPONSE_CACHE_SIZE.add_function(lambda: [({}, len(self.response_cache))])
+        self.model_locks = dict()
+        self.refillers = dict()
+        self.batchers = dict()
+        # Model name to (model, jokes pool)
+        self.jokes_pools = dict()
+        self.background_startup = background_startup
+        self.startup = StartupTimer()
+        self.ready = threading.Event()
+        self.startup_error = None
+        # Names of the models whose jokes pool was filled for the first time
+        self.warm_pools = set()
+        self.fallback_slo = fallback_slo
+        self.fallback_index = None
+        self.stream_update_interval = stream_update_interval
+        # Jokes served from the pools right away and after waiting for the refill,
+        # counted under the lock, the jokes are popped from several threads
+        self.buffer_hits = 0
+        self.buffer_misses = 0
+        self._buffer_stats_lock = threading.Lock()
+        POOL_SIZE.add_function(lambda: [({'model': name}, len(pool))
+                                        for name, (_, pool) in list(self.jokes_pools.items())])
+        QUEUE_DEPTH.add_function(lambda: [({'queue': f'batch_{name}'}, batcher.qsize())
+                                          for name, batcher in list(self.batchers.items())])
+
+    def wait_ready(self, timeout=None):
+        """Wait until the models are loaded.
+
+        :return: whether the generator is ready
+        :raises RuntimeError: if the startup failed
+        """
+        if not self.ready.wait(timeout):
+            return False
+        if self.startup_error is not None:
+            raise RuntimeError('Joke generator failed to start') from self.startup_error
+        return True
+
+    def _start(self, setup, *args):
+        """Run the setup loading the models, then set `ready` and report the startup timing."""
+        def run():
+            try:
+                setup(*args)
+            except Exception as e:
+                self.startup_error = e
+                print(f'[ERROR] startup: {e!r}')
+            self.ready.set()
+            self.startup.report()
+
+        if self.background_startup:
+            threading.Thread(target=run, name='Startup', daemon=True).start()
+        else:
+            run()
+            self.wait_ready()
 
     def positive_grade(self, user_id, joke_id):
         self.store.add_or_update_vote(
@@ -46,10 +145,13 @@ class AbstractJokeGenerator(ABC):
     def _prettify_result(self, model_output):
         def pp_answer(text):
             """Pretty-print the answer."""
-            # Remove all text after the stop token
-            text = text[: text.find(self.stop_token) if self.stop_token else None]
-            # Remove multiple answers
+            # Remove all text after the stop token, the partial answers may have none yet
+            end = text.find(self.stop_token) if self.stop_token else -1
+            if end != -1:
+                text = text[:end]
+            # Remove multiple answers and questions
             text = self.answer_token.join(text.split(self.answer_token, 2)[:2])
+            text = self.default_promt_token.join(text.split(self.default_promt_token, 2)[:2])
             # Replace model tokens with html formatted ones.
             text = re.sub(f'\{self.default_promt_token} *', '<b>Question:</b> ', text)
             text = re.sub(f'\{self.answer_token} *', '\n<b>Answer:</b> ', text)
@@ -60,51 +162,195 @@ class AbstractJokeGenerator(ABC):
         else:
             return [pp_answer(ans) for ans in model_output]
 
-    @synchronized
-    def generate_joke(self, model, promt=""):
+    def generate_joke(self, model, promt="", on_update=None):
         """Generate the joke from given promt.
         
         :param model: model to use to generate joke.
         :param promt: (optional) promt for a joke, if not given
         generates the whole joke
+        :param on_update: (optional) function called with the prettified
+        text generated so far while the answer to the promt is generated,
+        at most once per `stream_update_interval` seconds
         :return: `Joke` object
         """
         if promt:
-            print(f'[INFO] continue - Model: {model.name}')
-            res = self._continue_joke(model, promt)
+            res = self._get_cached_answer(model, promt)
+            if res is None:
+                print(f'[INFO] continue - Model: {model.name}')
+                answered = threading.Event()
+                callback = None
+                if on_update is not None:
+                    last_update = [float('-inf')]
+
+                    def callback(text):
+                        # Called after every token, the text is prettified only when it's sent
+                        now = time.monotonic()
+                        if not answered.is_set() and now - last_update[0] >= self.stream_update_interval:
+                            last_update[0] = now
+                            on_update(self._prettify_result(text))
+                future = self._continue_joke(model, promt, callback)
+                if self.response_cache is not None:
+                    future.add_done_callback(lambda future: self._cache_answer(model, promt, future))
+                res = self._wait_for_answer(future, promt)
+                answered.set()
         else:
             res = self._get_joke_from_buffer()
-        res['text'] = self._prettify_result(res['text'])
-        joke_id = self.store.add_joke(**res)
-        return Joke(id=joke_id, text=res['text'])
+        kind = 'text' if promt else 'joke'
+        with STAGE_SECONDS.time(stage='prettify', model=res['generated_by'], kind=kind):
+            # Copy, the answer may be added to the response cache at the same time
+            res = dict(res, text=self._prettify_result(res['text']))
+        with STAGE_SECONDS.time(stage='storage_write', model=res['generated_by'], kind=kind):
+            joke_id = self.store.add_joke(**res)
+        return Joke(id=joke_id, text=res['text'], generated_by=res['generated_by'])
     
-    @synchronized
-    def __call_model(self, model, prompt, num_return_sequences):
+    def __call_model(self, model, prompt, num_return_sequences, callbacks=None):
         """Call the model to generate the joke.
 
         :param model: model to use
-        :param promt: prompt for the model
-        :param num_return_sequences: number of sequences to generate
+        :param promt: prompt for the model or list of prompts
+        to generate one sequence for each in a single batch
+        :param num_return_sequences: number of sequences to generate,
+        ignored for the list of prompts
+        :param callbacks: (optional) streaming callbacks for the list of prompts,
+        see `ModelWrapper.generate_batch`
         :return: list of (num_return_sequences) dicts
         with 'text' and 'generated_by' fields
         """
+        with self.model_locks[model.name]:
+            if isinstance(prompt, str):
+                sequences = model.generate(prompt, num_return_sequences)
+            else:
+                sequences = model.generate_batch(prompt, callbacks)
         return [{
             'generated_by': model.name,
             'text': seq
-        } for seq in model.generate(prompt, num_return_sequences)]
+        } for seq in sequences]
     
-    @synchronized
-    def _fill_jokes_buffer(self, model):
-        """Fill the jokes buffer associated with given model.
+    def _fill_jokes_buffer(self, model, num_return_sequences=None):
+        """Generate the jokes for the buffer associated with given model.
         WARNING: Default implementation just returns the result.
 
         :param model: model to use
+        :param num_return_sequences: (optional) number of jokes to generate,
+        defaults to the buffer size
         :return: see `__call_model` function
         """
+        if num_return_sequences is None:
+            num_return_sequences = self.jokes_buffer_size
         return self.__call_model(model, self.default_promt_token,
-                                num_return_sequences=self.jokes_buffer_size)
+                                num_return_sequences=num_return_sequences)
+
+    def _load_model(self, model_path):
+        """Load the model and register its lock."""
+        model_name = os.path.split(model_path)[1]
+        with self.startup.phase(f'load {model_name}'):
+            model = load_model(model_path, model_name,
+                               num_workers=self.model_workers,
+                               device=self.model_device,
+                               backend=self.model_backend,
+                               max_length=self.max_joke_len,
+                               prompt_prefixes=[self.default_promt_token],
+                               stop_texts=self.stop_texts)
+        self.model_locks[model.name] = threading.BoundedSemaphore(model.concurrency)
+        return model
+
+    def _create_jokes_pool(self, model):
+        """Create the jokes pool for given model with the jokes saved by `save_jokes_pools`
+        if the checkpoint is the same, the rest is filled by the refiller."""
+        pool = JokesPool(model.name, target_size=self.jokes_buffer_size,
+                         low_watermark=self.jokes_buffer_low_watermark)
+        jokes = self.store.pop_pooled_jokes(model.name, model.fingerprint)
+        if jokes:
+            print(f'[INFO] restored - Model: {model.name}, jokes: {len(jokes)}')
+            pool.extend(jokes)
+        self.jokes_pools[model.name] = (model, pool)
+        return pool
+
+    def save_jokes_pools(self, timeout=30):
+        """Stop the refillers and save the unserved jokes to serve them after the restart.
+
+        :param timeout: max seconds to wait for each refill in progress
+        """
+        for refiller in self.refillers.values():
+            refiller.stop()
+        # The jokes of the refill in progress are added to the pool before it's saved
+        for name, refiller in self.refillers.items():
+            refiller.join(timeout)
+            if refiller.is_alive():
+                print(f'[WARN] saved - Model: {name}, the refill is still running, its jokes are lost')
+        for name, (model, pool) in self.jokes_pools.items():
+            jokes = pool.drain()
+            self.store.save_pooled_jokes(name, model.fingerprint, jokes)
+            print(f'[INFO] saved - Model: {name}, jokes: {len(jokes)}')
+
+    def close(self, timeout=30):
+        """Stop the refillers and the batchers and wait for them, so no generation
+        is running when the interpreter exits, then close the models.
+
+        :param timeout: max seconds to wait for the startup and for each worker
+        """
+        self.ready.wait(timeout)
+        for refiller in self.refillers.values():
+            refiller.stop()
+        for refiller in self.refillers.values():
+            refiller.join(timeout)
+        for batcher in self.batchers.values():
+            batcher.close(timeout)
+        for model, _ in self.jokes_pools.values():
+            model.close()
+
+    def _start_refillers(self, models, pools):
+        """Start the background workers topping up the pools of given models."""
+        for model, pool in zip(models, pools):
+            def fill_pool(pool, num_return_sequences, model=model):
+                jokes = self._fill_jokes_buffer(model, num_return_sequences)
+                if model.name not in self.warm_pools:
+                    self.warm_pools.add(model.name)
+                    seconds = self.startup.since_start(f'buffer warm-up {model.name}')
+                    print(f'[INFO] startup - buffer warm-up {model.name}: {seconds:.2f} s')
+                return jokes
+
+            self.refillers[model.name] = BufferRefiller(
+                fill_pool, [pool], name=f'BufferRefiller-{model.name}')
+            self.refillers[model.name].start()
+
+    def _start_batchers(self, models):
+        """Start the micro-batching schedulers for prompted continuations."""
+        for model in models:
+            def process_batch(requests, model=model):
+                prompts, callbacks = zip(*requests)
+                return self.__call_model(model, list(prompts), num_return_sequences=1,
+                                         callbacks=list(callbacks))
+
+            self.batchers[model.name] = BatchScheduler(
+                process_batch, max_batch_size=self.max_batch_size,
+                max_wait_ms=self.max_batch_wait_ms,
+                max_concurrent_batches=model.concurrency,
+                name=f'BatchScheduler-{model.name}')
+            self.batchers[model.name].start()
+
+    def _pop_joke(self, pool):
+        """Get the joke from the pool, waking up the refiller if needed."""
+        if pool.needs_refill():
+            self.refillers[pool.name].notify()
+        joke = pool.pop(timeout=0)
+        if joke is None:
+            with self._buffer_stats_lock:
+                self.buffer_misses += 1
+            BUFFER_POPS.inc(model=pool.name, result='miss')
+            print(f'[WARN] buffer miss - Model: {pool.name}')
+            joke = pool.pop(timeout=self.jokes_buffer_wait)
+            if joke is None:
+                # The pool is still warming up or the refill is slow,
+                # this joke is generated along with the user prompts
+                print(f'[WARN] buffer empty - Model: {pool.name}, generating the joke')
+                joke = self.batchers[pool.name].submit((self.default_promt_token, None)).result()
+        else:
+            with self._buffer_stats_lock:
+                self.buffer_hits += 1
+            BUFFER_POPS.inc(model=pool.name, result='hit')
+        return joke
     
-    @synchronized
     @abstractmethod
     def _get_joke_from_buffer(self, model):
         """Get the new joke from the buffer for given model.
@@ -112,101 +358,208 @@ class AbstractJokeGenerator(ABC):
         """
         pass
     
-    @synchronized
-    def _continue_joke(self, model, promt):
-        """Continue the joke given in promt."""
+    def _continue_joke(self, model, promt, callback=None):
+        """Continue the joke given in promt.
+        Concurrent calls are batched together by the model's `BatchScheduler`.
+
+        :param callback: (optional) function called with the text generated so far
+        :return: `Future` of the joke dict
+        """
+        model_promt = self.custom_promt.format(' ' + promt.strip())
+        return self.batchers[model.name].submit((model_promt, callback))
+
+    def _wait_for_answer(self, future, promt):
+        """Wait for the generated answer or, once `fallback_slo` passes,
+        take the dataset joke with the most similar question if there is one."""
+        if not self.fallback_slo or self.fallback_index is None:
+            return future.result()
+        try:
+            return future.result(timeout=self.fallback_slo)
+        except TimeoutError:
+            res = self.fallback_index.answer(promt)
+            if res is None:
+                return future.result()
+            print(f'[INFO] continue - fallback: {res["generated_by"]}')
+            return res
+
+    def _build_fallback_index(self, datasets):
+        """Build the retrieval index of the datasets in the background if the fallback is on."""
+        if not self.fallback_slo or not datasets:
+            return
+
+        def build():
+            with self.startup.phase('build fallback index'):
+                self.fallback_index = RetrievalIndex(datasets)
+            print(f'[INFO] fallback index - jokes: {self.fallback_index.num_docs}')
+
+        threading.Thread(target=build, name='FallbackIndex', daemon=True).start()
+
+    def _cache_answer(self, model, promt, future):
+        """Add the generated answer to the response cache, even if the fallback was served."""
+        if future.exception() is None:
+            self.response_cache.add(promt, future.result(), model=model.name)
+
+    def _get_cached_answer(self, model, promt):
+        """Get the answer of the model to the promt from the response cache."""
+        if self.response_cache is None:
+            return None
+        res = self.response_cache.get(promt, model=model.name)
+        RESPONSE_CACHE_LOOKUPS.inc(model=model.name, result='miss' if res is None else 'hit')
+        if res is not None:
+            print(f'[INFO] continue - cache hit - Model: {model.name}')
+            # Only the repeated prompts are worth more answers,
+            # the one-off ones would delay the user requests behind them
+            self._top_up_cached_answers(model, promt)
+        return res
+
+    def _top_up_cached_answers(self, model, promt):
+        """Generate the missing cached answers to the promt in the background."""
         model_promt = self.custom_promt.format(' ' + promt.strip())
-        return self.__call_model(model, model_promt, num_return_sequences=1)[0]
+
+        def on_done(future):
+            if future.exception() is None:
+                self.response_cache.add(promt, future.result(), pending=True, model=model.name)
+            else:
+                self.response_cache.release(promt, model=model.name)
+
+        for _ in range(self.response_cache.reserve(promt, model=model.name)):
+            self.batchers[model.name].submit((model_promt, None)).add_done_callback(on_done)
 
 class JokeGenerator(AbstractJokeGenerator):
     """Simple Joke generator using one model."""
 
-    def __init__(self, model_path, max_joke_len=40, jokes_buffer_size=16, model_device='cpu'):
-        super().__init__(jokes_buffer_size)
-        model_name = os.path.split(model_path)[1]
-        self.model = ModelWrapper(model_path, model_name, max_length=max_joke_len)
-        self._fill_jokes_buffer()
-
-    @synchronized
-    def _fill_jokes_buffer(self):
-        self.jokes_buffer = super()._fill_jokes_buffer(self.model)
+    def __init__(self, model_path, dataset_paths=(), **kwargs):
+        """
+        :param model_path: path to the model
+        :param dataset_paths: (optional) paths to the datasets
+        for the fallback answers, see `fallback_slo`
+        :param kwargs: see `AbstractJokeGenerator`
+        """
+        super().__init__(**kwargs)
+        self.model = None
+        self.jokes_buffer = None
+        self._start(self._setup, model_path, dataset_paths)
+
+    def _setup(self, model_path, dataset_paths):
+        if self.fallback_slo:
+            self._build_fallback_index([Dataset(path) for path in dataset_paths])
+        self.model = self._load_model(model_path)
+        self.jokes_buffer = self._create_jokes_pool(self.model)
+        self._start_refillers([self.model], [self.jokes_buffer])
+        self._start_batchers([self.model])
 
-    @synchronized
     def _get_joke_from_buffer(self):
-        if len(self.jokes_buffer) == 0:
-            self._fill_jokes_buffer()
-        return self.jokes_buffer.pop()
+        return self._pop_joke(self.jokes_buffer)
 
-    @synchronized
-    def generate_joke(self, promt=""):
-        return super().generate_joke(self.model, promt)
+    def generate_joke(self, promt="", on_update=None):
+        self.wait_ready()
+        return super().generate_joke(self.model, promt, on_update)
 
 
 class TestABGenerator(AbstractJokeGenerator):
     """Joke generator for a/b testing.
     Outputs the joke from either of models/datasets.
-    Chooses the source randomly."""
-    def __init__(self, dataset_paths, model_paths, max_joke_len=40, jokes_buffer_size=16, model_device='cpu'):
+    The source is chosen by the `scheduling.PoolScheduler`
+    keeping the traffic split between them."""
+    def __init__(self, dataset_paths, model_paths, traffic_split=None,
+                 scheduler='ready', **kwargs):
         """
         Loads datasets and models. Initiates pools and orders of passing
         :param dataset_paths: paths to the dataset
         :param model_paths: paths to the model
+        :param traffic_split: (optional) weights of the datasets and then
+        the models in the traffic, equal by default
+        :param scheduler: name of the scheduler, see `scheduling.SCHEDULERS`
+        :param kwargs: see `AbstractJokeGenerator`
         """
-        super().__init__(jokes_buffer_size)
+        super().__init__(**kwargs)
+        if traffic_split is None:
+            traffic_split = [1] * (len(dataset_paths) + len(model_paths))
+        if len(traffic_split) != len(dataset_paths) + len(model_paths):
+            raise ValueError('traffic_split should have a weight for every dataset and model')
+        if scheduler not in SCHEDULERS:
+            raise ValueError(f'Unknown scheduler {scheduler}, should be one of: {", ".join(SCHEDULERS)}')
 
         self.models = list()
         self.key2pool = dict()
-        for model_path in model_paths:
-            model_name = os.path.split(model_path)[1]
-            self.models.append(ModelWrapper(model_path, model_name, max_length=max_joke_len))
-            self._fill_jokes_buffer(self.models[-1])
-
-        self.datasets = [Dataset(path) for path in dataset_paths]
+        self.datasets = list()
+        self.num_of_pools = 0
+        self.traffic_split = traffic_split
+        self.scheduler_class = SCHEDULERS[scheduler]
+        self.scheduler = None
+        self._start(self._setup, dataset_paths, model_paths)
+
+    def _load_datasets(self, dataset_paths):
+        with self.startup.phase('load datasets'):
+            return [Dataset(path) for path in dataset_paths]
+
+    def _setup(self, dataset_paths, model_paths):
+        # Models and datasets are loaded at the same time
+        with ThreadPoolExecutor(len(model_paths) + 1) as executor:
+            datasets = executor.submit(self._load_datasets, dataset_paths)
+            models = list(executor.map(self._load_model, model_paths))
+        for model in models:
+            self.key2pool[model.name] = self._create_jokes_pool(model)
+        self._start_refillers(models, [self.key2pool[model.name] for model in models])
+        self._start_batchers(models)
+
+        self.datasets = datasets.result()
+        self._build_fallback_index(self.datasets)
+        self.models = models
         self.num_of_pools = len(self.models) + len(self.datasets)
+        names = [source.name for source in self.datasets + self.models]
+        self.scheduler = self.scheduler_class(dict(zip(names, self.traffic_split)))
 
-    @synchronized
-    def generate_joke(self, promt=""):
+    def generate_joke(self, promt="", on_update=None):
+        self.wait_ready()
         idx = random.randint(0, len(self.models) - 1)
         model = self.models[idx]
-        return super().generate_joke(model, promt)
-
-    @synchronized
-    def _fill_jokes_buffer(self, model):
-        self.key2pool[model.name] = super()._fill_jokes_buffer(model)
+        return super().generate_joke(model, promt, on_update)
 
-    @synchronized
     def _get_joke_from_buffer(self):
-        idx = random.randint(0, self.num_of_pools - 1)
-        res = {}
-        if idx < len(self.datasets):
-            print(f'[INFO] generate - Dataset: {self.datasets[idx].name}')
-            return random.choice(self.datasets[idx])
-        idx = idx - len(self.datasets) - 1
-        key = self.models[idx].name
+        # Datasets are always ready, models when their pools aren't empty
+        ready = {dataset.name: True for dataset in self.datasets}
+        ready.update((key, len(pool) > 0) for key, pool in self.key2pool.items())
+        key = self.scheduler.pick(ready)
+        if key not in self.key2pool:
+            dataset = next(dataset for dataset in self.datasets if dataset.name == key)
+            print(f'[INFO] generate - Dataset: {key}')
+            return random.choice(dataset)
         print(f'[INFO] generate - Model: {key}')
-        if len(self.key2pool[key]) == 0:
-            self._fill_jokes_buffer(self.models[idx])
-        return self.key2pool[key].pop()
+        return self._pop_joke(self.key2pool[key])
 
 
 class Dataset:
-    """Wrapper for the DataFrame to return values similar 
+    """Jokes of the csv dataset with values similar
     to `AbstractJokeGenerator` output.
+
+    The formatted jokes are precomputed once to the compact store next
+    to the csv, which is rebuilt when the csv changes.
     """
 
-    def __init__(self, dataset_path):
+    def __init__(self, dataset_path, mmap=True):
+        """
+        :param dataset_path: path to the csv with 'Question' and 'Answer' columns
+        :param mmap: map the store to memory instead of reading it, see `JokesStore`
+        """
         self.name = os.path.split(dataset_path)[1]
-        self.data = pd.read_csv(dataset_path)
+        store_path = dataset_path + '.jokes'
+        if (not os.path.exists(store_path)
+                or os.path.getmtime(store_path) < os.path.getmtime(dataset_path)):
+            print(f'[INFO] dataset - building {store_path}')
+            build_store(dataset_path, store_path, self._format_joke)
+        self.data = JokesStore(store_path, mmap=mmap)
+
+    @staticmethod
+    def _format_joke(row):
+        return (JokeGenerator.default_promt_token
+                + row['Question'].strip() + '\n'
+                + JokeGenerator.answer_token + ' '
+                + row['Answer'].strip())
 
     def __getitem__(self, idx):
-        question = self.data['Question'].iloc[idx].strip()
-        answer = self.data['Answer'].iloc[idx].strip()
-        text = (JokeGenerator.default_promt_token
-                + question + '\n'
-                + JokeGenerator.answer_token + ' '
-                + answer)
         return {
-            'text': text,
+            'text': self.data[idx],
             'generated_by': self.name,
         }
 
@@ -0,0 +1,103 @@
+import threading
+from collections import deque
+
+
+class JokesPool:
+    """Thread-safe pool of pre-generated jokes for one model.
+
+    Jokes are served from the pool while `BufferRefiller` tops it up
+    in the background once it drops to the low watermark.
+    """
+
+    def __init__(self, name, target_size=16, low_watermark=4):
+        """
+        :param name: name of the model the pool belongs to
+        :param target_size: number of jokes the refill tops the pool up to
+        :param low_watermark: pool size at which refill is requested
+        """
+        if not 0 <= low_watermark < target_size:
+            raise ValueError('low_watermark should be in [0, target_size)')
+        self.name = name
+        self.target_size = target_size
+        self.low_watermark = low_watermark
+        self._jokes = deque()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._jokes)
+
+    def needs_refill(self):
+        return len(self._jokes) <= self.low_watermark
+
+    def missing(self):
+        """Number of jokes needed to reach the target size."""
+        return max(self.target_size - len(self._jokes), 0)
+
+    def extend(self, jokes):
+        with self._cond:
+            self._jokes.extend(jokes)
+            self._cond.notify_all()
+
+    def pop(self, timeout=None):
+        """Get the joke from the pool, waiting for the refill if it is empty.
+
+        :param timeout: (optional) max seconds to wait for the refill
+        :return: joke dict or None if the timeout expired
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._jokes, timeout):
+                return None
+            return self._jokes.popleft()
+
+    def drain(self):
+        """Take all the jokes out of the pool."""
+        with self._cond:
+            jokes = list(self._jokes)
+            self._jokes.clear()
+            return jokes
+
+
+class BufferRefiller(threading.Thread):
+    """Background worker keeping the jokes pools above the low watermark."""
+
+    def __init__(self, fill_pool, pools, poll_interval=1.0, name='BufferRefiller'):
+        """
+        :param fill_pool: function taking `JokesPool` and the number
+        of jokes to generate, returns the list of generated jokes
+        :param pools: list of `JokesPool` to maintain
+        :param poll_interval: seconds between checks of the pools
+        :param name: name of the worker thread
+        """
+        super().__init__(name=name, daemon=True)
+        self.fill_pool = fill_pool
+        self.pools = pools
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+
+    def notify(self):
+        """Ask the worker to check the pools right now."""
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def refill(self, pool):
+        missing = pool.missing()
+        if missing > 0:
+            print(f'[INFO] refill - Model: {pool.name}, jokes: {missing}')
+            pool.extend(self.fill_pool(pool, missing))
+
+    def run(self):
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            for pool in self.pools:
+                if self._stopped.is_set():
+                    break
+                if pool.needs_refill():
+                    try:
+                        self.refill(pool)
+                    except Exception as e:
+                        print(f'[ERROR] refill - Model: {pool.name}: {e!r}')
+            self._wakeup.wait(self.poll_interval)
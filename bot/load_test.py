@@ -0,0 +1,350 @@
+"""
+Load test of the bot serving path with tiny randomly initialized GPT-2 models,
+so it runs anywhere without downloading the models.
+
+Fake Telegram updates, mixed /joke commands and typed questions, are sent
+to the `main_bot` handlers by a number of concurrent users. Reports latency
+percentiles, throughput, buffer miss rate and database write latency, and
+appends the results to a jsonl file to compare them between commits.
+
+    python bot/load_test.py --requests 200 --concurrency 8 --joke-ratio 0.5
+
+Throughput of two models refilling their pools from two threads behind one
+shared lock, as before the per-model locks, and behind `model_locks`:
+
+    python bot/load_test.py --models 2 --compare-locks
+
+Throughput of two models served in one process and by `ModelWorkerPool`:
+
+    python bot/load_test.py --models 2 --compare-workers --model-workers 2
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import tempfile
+import threading
+import time
+import types
+
+import numpy as np
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+try:
+    from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+except ImportError:
+    from transformers.tokenization_gpt2 import bytes_to_unicode
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+QUESTIONS = [
+    "Why did the chicken cross the road?",
+    "How many programmers does it take to change a light bulb?",
+    "What do you call a fish without eyes?",
+    "Why don't scientists trust atoms?",
+    "What's the best thing about Switzerland?",
+]
+
+
+def make_tiny_model(path, n_layer=2, n_embd=64, n_head=4, n_positions=256, seed=0):
+    """Save the randomly initialized GPT-2 with the byte-level tokenizer without merges."""
+    os.makedirs(path, exist_ok=True)
+    vocab = {token: i for i, token in enumerate(bytes_to_unicode().values())}
+    vocab['<|endoftext|>'] = len(vocab)
+    with open(os.path.join(path, 'vocab.json'), 'w', encoding='utf-8') as f:
+        json.dump(vocab, f)
+    with open(os.path.join(path, 'merges.txt'), 'w', encoding='utf-8') as f:
+        f.write('#version: 0.2\n')
+    config = GPT2Config(vocab_size=len(vocab), n_layer=n_layer, n_embd=n_embd, n_head=n_head,
+                        n_positions=n_positions, bos_token_id=len(vocab) - 1, eos_token_id=len(vocab) - 1)
+    torch.manual_seed(seed)
+    GPT2LMHeadModel(config).save_pretrained(path)
+    return path
+
+
+def percentiles(values):
+    if not len(values):
+        return {'p50': None, 'p90': None, 'p99': None, 'mean': None}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {'p50': float(p50), 'p90': float(p90), 'p99': float(p99), 'mean': float(np.mean(values))}
+
+
+class FakeMessage:
+    """Telegram message recording the time of the replies and edits."""
+
+    def __init__(self, chat_id, text='', send_latency=0.0):
+        self.chat_id = chat_id
+        self.chat = types.SimpleNamespace(id=chat_id)
+        self.text = text
+        self.send_latency = send_latency
+        self.replies = list()
+
+    async def reply_text(self, text, **kwargs):
+        await asyncio.sleep(self.send_latency)
+        self.replies.append(time.perf_counter())
+        reply = FakeMessage(self.chat_id, text, self.send_latency)
+        reply.replies = self.replies
+        return reply
+
+    async def edit_text(self, text, **kwargs):
+        await asyncio.sleep(self.send_latency)
+        self.replies.append(time.perf_counter())
+        self.text = text
+
+
+class FakeBot:
+    async def send_chat_action(self, chat_id, action):
+        pass
+
+
+async def run_traffic(main_bot, questions, num_requests, concurrency, joke_ratio, send_latency):
+    """Send the requests from `concurrency` users, each waits for the answer before the next one.
+
+    :return: list of dicts with the request kind, latency and time to the first reply
+    """
+    context = types.SimpleNamespace(bot=FakeBot())
+    requests = iter(range(num_requests))
+    results = list()
+
+    async def user(user_id):
+        for _ in requests:
+            is_joke = random.random() < joke_ratio
+            message = FakeMessage(user_id, '' if is_joke else random.choice(questions), send_latency)
+            update = types.SimpleNamespace(message=message, effective_message=message)
+            start = time.perf_counter()
+            if is_joke:
+                await main_bot.joke_command_handler(update, context)
+            else:
+                await main_bot.text_handler(update, context)
+            results.append({
+                'kind': 'joke' if is_joke else 'text',
+                'latency': time.perf_counter() - start,
+                'first_reply': message.replies[0] - start if message.replies else None,
+            })
+
+    await asyncio.gather(*[user(i) for i in range(concurrency)])
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BOT_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_load_test(args):
+    workdir = tempfile.mkdtemp(prefix='load_test_')
+    model_paths = [make_tiny_model(os.path.join(workdir, f'tiny{i}'), seed=args.seed + i)
+                   for i in range(args.models)]
+    dataset_path = os.path.abspath(args.dataset)
+    # The database is created in the working directory
+    os.chdir(workdir)
+    import main_bot
+    import storage
+    from joke_generator import Dataset, JokeGenerator, TestABGenerator
+    from retrieval import RetrievalIndex
+    from runtime import InferenceExecutor
+
+    storage.init()
+
+    questions = QUESTIONS
+    if os.path.exists(dataset_path):
+        dataset = Dataset(dataset_path)
+        jokes = [dataset[random.randrange(len(dataset))]['text'] for _ in range(1000)]
+        questions = [m.group(1) for m in map(RetrievalIndex.question_pattern.match, jokes) if m]
+
+    model_args = dict(main_bot.model_args, max_joke_len=args.max_joke_len, model_backend=args.backend,
+                      background_startup=False, fallback_slo=args.fallback_slo,
+                      model_workers=args.model_workers, stream_update_interval=args.stream_update_interval)
+    if args.ab:
+        generator = TestABGenerator([dataset_path], model_paths, **model_args)
+    else:
+        generator = JokeGenerator(model_paths[0], dataset_paths=[dataset_path], **model_args)
+    main_bot.joke_generator = generator
+    main_bot.inference = InferenceExecutor(max_in_flight=args.max_in_flight, max_queue=args.max_queue,
+                                           timeout=args.timeout)
+    try:
+        # Measure the steady state with the warm buffers
+        while len(generator.warm_pools) < len(generator.jokes_pools):
+            time.sleep(0.1)
+
+        main_bot.stream_answers = args.stream
+        main_bot.stream_update_interval = args.stream_update_interval
+
+        start = time.perf_counter()
+        results = asyncio.run(run_traffic(main_bot, questions, args.requests, args.concurrency,
+                                          args.joke_ratio, args.send_latency))
+        duration = time.perf_counter() - start
+        storage.writer.flush()
+    finally:
+        # Generation still running in the background threads at exit aborts the interpreter
+        generator.close()
+        main_bot.inference.shutdown()
+
+    served = generator.buffer_hits + generator.buffer_misses
+    report = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'args': vars(args),
+        'requests': len(results),
+        'duration': duration,
+        'throughput': len(results) / duration,
+        'latency': percentiles([r['latency'] for r in results]),
+        'latency_joke': percentiles([r['latency'] for r in results if r['kind'] == 'joke']),
+        'latency_text': percentiles([r['latency'] for r in results if r['kind'] == 'text']),
+        'first_reply_text': percentiles([r['first_reply'] for r in results
+                                         if r['kind'] == 'text' and r['first_reply'] is not None]),
+        'buffer_miss_rate': generator.buffer_misses / served if served else 0.0,
+        'db_write_latency': percentiles(list(storage.writer.latencies)),
+    }
+    if generator.response_cache is not None:
+        report['response_cache'] = generator.response_cache.stats()
+    return report
+
+
+def compare_locks(args):
+    """Refill the pools of the models at once, one thread per model, first with
+    every model behind one shared lock, then with the per-model `model_locks`.
+
+    :return: dict of the locking to the throughput in jokes per second
+    """
+    workdir = tempfile.mkdtemp(prefix='load_test_')
+    model_paths = [make_tiny_model(os.path.join(workdir, f'tiny{i}'), seed=args.seed + i)
+                   for i in range(max(args.models, 2))]
+    # The database is created in the working directory
+    os.chdir(workdir)
+    import storage
+    from joke_generator import TestABGenerator
+
+    storage.init()
+    generator = TestABGenerator([], model_paths, max_joke_len=args.max_joke_len, model_backend=args.backend,
+                                response_cache_size=0, background_startup=False)
+    results = dict()
+    try:
+        # The refillers are idle once the pools are full, only the threads below generate
+        while len(generator.warm_pools) < len(generator.jokes_pools):
+            time.sleep(0.1)
+        model_locks = generator.model_locks
+        shared_lock = threading.BoundedSemaphore(1)
+        for locking, locks in (('shared lock', {name: shared_lock for name in model_locks}),
+                               ('per-model locks', model_locks)):
+            generator.model_locks = locks
+
+            def refill(model):
+                for _ in range(args.refills):
+                    generator._fill_jokes_buffer(model)
+
+            threads = [threading.Thread(target=refill, args=(model,)) for model in generator.models]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            duration = time.perf_counter() - start
+            results[locking] = len(threads) * args.refills * generator.jokes_buffer_size / duration
+            print(f'[INFO] load test - {len(threads)} models, {locking}: {results[locking]:.1f} jokes/s')
+        generator.model_locks = model_locks
+    finally:
+        generator.close()
+    print(f"[INFO] load test - per-model locks {results['per-model locks'] / results['shared lock'] - 1:+.1%} "
+          f"vs the shared lock, torch threads: {torch.get_num_threads()}")
+    return results
+
+
+def compare_workers(args):
+    """Run the load test with the models in this process, then served by the worker pools.
+
+    :return: (report in one process, report with the worker pools)
+    """
+    reports = list()
+    for model_workers in (1, max(args.model_workers, 2)):
+        print(f'[INFO] load test - models: {args.models}, model workers: {model_workers}')
+        reports.append(run_load_test(argparse.Namespace(**dict(vars(args), model_workers=model_workers))))
+    single, pooled = reports
+    print(f"[INFO] load test - {args.models} models, throughput {single['throughput']:.2f} req/s in one process, "
+          f"{pooled['throughput']:.2f} req/s with {pooled['args']['model_workers']} workers per model "
+          f"({pooled['throughput'] / single['throughput'] - 1:+.1%})")
+    return single, pooled
+
+
+def print_report(report, previous=None):
+    def fmt(stats):
+        if stats['p50'] is None:
+            return '-'
+        return f"p50 {stats['p50'] * 1000:.1f} ms, p90 {stats['p90'] * 1000:.1f} ms, p99 {stats['p99'] * 1000:.1f} ms"
+
+    print(f"[INFO] load test - commit {report['commit']}, {report['requests']} requests "
+          f"in {report['duration']:.1f} s, {report['throughput']:.2f} req/s")
+    for key in ('latency', 'latency_joke', 'latency_text', 'first_reply_text', 'db_write_latency'):
+        line = f'[INFO] load test - {key}: {fmt(report[key])}'
+        if previous is not None and previous.get(key, {}).get('p50') and report[key]['p50']:
+            line += f" (p50 {report[key]['p50'] / previous[key]['p50'] - 1:+.1%} vs {previous['commit']})"
+        print(line)
+    print(f"[INFO] load test - buffer miss rate: {report['buffer_miss_rate']:.3f}")
+    if previous is not None:
+        print(f"[INFO] load test - throughput {report['throughput'] / previous['throughput'] - 1:+.1%} "
+              f"vs {previous['commit']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the bot with a tiny random model')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8, help='number of users sending the requests')
+    parser.add_argument('--joke-ratio', type=float, default=0.5, help='share of /joke among the requests')
+    parser.add_argument('--ab', action='store_true', help='serve with TestABGenerator')
+    parser.add_argument('--models', type=int, default=1,
+                        help='number of tiny models served in parallel by TestABGenerator, implies --ab if > 1')
+    parser.add_argument('--dataset', default=os.path.join(BOT_DIR, '..', 'data', 'qa_jokes.csv'))
+    parser.add_argument('--backend', default='eager')
+    parser.add_argument('--model-workers', type=int, default=1,
+                        help='processes serving each model, see worker_pool.ModelWorkerPool')
+    parser.add_argument('--compare-locks', action='store_true',
+                        help='only compare the throughput of the models refilling from one thread each, '
+                             'behind one shared lock and behind the per-model locks')
+    parser.add_argument('--refills', type=int, default=5,
+                        help='pool refills of each model for --compare-locks')
+    parser.add_argument('--compare-workers', action='store_true',
+                        help='run with the models in one process and then with --model-workers '
+                             '(at least 2) processes per model, and compare the throughput')
+    parser.add_argument('--max-joke-len', type=int, default=40)
+    parser.add_argument('--fallback-slo', type=float, default=0)
+    parser.add_argument('--max-in-flight', type=int, default=8)
+    parser.add_argument('--max-queue', type=int, default=1000)
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--stream', action='store_true', help='stream the answers to the questions')
+    parser.add_argument('--stream-update-interval', type=float, default=0.2)
+    parser.add_argument('--send-latency', type=float, default=0.0, help='seconds each Telegram call takes')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default=os.path.join(BOT_DIR, 'load_test_results.jsonl'),
+                        help='jsonl file the results are appended to')
+    args = parser.parse_args()
+    args.output = os.path.abspath(args.output)
+    args.ab = args.ab or args.models > 1
+    random.seed(args.seed)
+
+    previous = None
+    if os.path.exists(args.output):
+        with open(args.output, encoding='utf-8') as f:
+            lines = [line for line in f if line.strip()]
+        if lines:
+            previous = json.loads(lines[-1])
+    if args.compare_locks:
+        compare_locks(args)
+        return
+    if args.compare_workers:
+        reports = compare_workers(args)
+    else:
+        reports = [run_load_test(args)]
+    for report in reports:
+        print_report(report, previous)
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(report) + '\n')
+        previous = report
+
+
+if __name__ == '__main__':
+    main()
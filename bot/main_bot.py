@@ -1,12 +1,18 @@
+import asyncio
 import logging
 import os
+import time
 from functools import wraps
 from configparser import ConfigParser
 
+import storage
 import telegram
 from joke_generator import JokeGenerator, TestABGenerator
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ChatAction
-from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler, Filters
+from metrics import QUEUE_DEPTH, REQUEST_SECONDS, STAGE_SECONDS, start_http_server
+from runtime import Busy, InferenceExecutor
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ChatAction, ParseMode
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters
 
 """
 Basic example for a bot that uses inline keyboards.
@@ -25,15 +31,43 @@ dataset_paths = model_cfg['dataset_paths'].split(',')
 model_args = {
     'max_joke_len': int(model_cfg['max_joke_len']),
     'jokes_buffer_size': int(model_cfg['buffer_size']),
-    'model_device': model_cfg['device']
+    'jokes_buffer_low_watermark': int(model_cfg['buffer_low_watermark']),
+    'jokes_buffer_wait': float(model_cfg['buffer_wait']),
+    'max_batch_size': int(model_cfg['batch_max_size']),
+    'max_batch_wait_ms': int(model_cfg['batch_max_wait_ms']),
+    'model_workers': int(model_cfg['model_workers']),
+    'model_backend': model_cfg['backend'],
+    'model_device': model_cfg['device'],
+    'response_cache_size': int(model_cfg['response_cache_size']),
+    'response_cache_ttl': float(model_cfg['response_cache_ttl']),
+    'response_cache_answers': int(model_cfg['response_cache_answers']),
+    'background_startup': model_cfg['background_startup'].lower() == 'true',
+    'fallback_slo': float(model_cfg['fallback_slo']),
 }
-if cfg['bot']['ab_test'].lower() == 'true':
-    joke_generator = TestABGenerator(dataset_paths=dataset_paths,
-                                    model_paths=model_paths,
-                                    **model_args
-                                    )
-else:
-    joke_generator = JokeGenerator(model_path=model_paths[0], **model_args)
+stream_answers = cfg['bot']['stream_answers'].lower() == 'true'
+stream_update_interval = float(cfg['bot']['stream_update_interval'])
+joke_generator = None
+inference = None
+busy_text = "I'm telling too many jokes at once right now, please ask me again in a minute"
+timeout_text = "Sorry, I couldn't come up with a joke in time, please try again"
+warming_up_text = "I'm just waking up, please ask me again in a few seconds"
+
+
+def create_joke_generator():
+    # Not done at import time: model worker processes are spawned
+    # and import this module again
+    if cfg['bot']['ab_test'].lower() == 'true':
+        traffic_split = cfg['bot']['ab_split'].strip()
+        return TestABGenerator(dataset_paths=dataset_paths,
+                               model_paths=model_paths,
+                               traffic_split=[float(w) for w in traffic_split.split(',')] if traffic_split else None,
+                               scheduler=cfg['bot']['ab_scheduler'],
+                               stream_update_interval=stream_update_interval,
+                               **model_args
+                               )
+    return JokeGenerator(model_path=model_paths[0], dataset_paths=dataset_paths,
+                         stream_update_interval=stream_update_interval, **model_args)
+
 
 splitter = "::"
 pos = "1"
@@ -44,27 +78,123 @@ def send_typing_action(func):
     """Sends typing action while processing func command."""
 
     @wraps(func)
-    def command_func(update, context, *args, **kwargs):
-        context.bot.send_chat_action(chat_id=update.effective_message.chat_id,
-                                     action=ChatAction.TYPING)
-        return func(update, context,  *args, **kwargs)
+    async def command_func(update, context, *args, **kwargs):
+        await context.bot.send_chat_action(chat_id=update.effective_message.chat_id,
+                                           action=ChatAction.TYPING)
+        return await func(update, context,  *args, **kwargs)
 
     return command_func
 
 
-@send_typing_action
-def joke_command_handler(update, context):
-    general_joke_handler(update, context, promt_text="")
+class StreamingReply:
+    """Sends the answer as soon as its first tokens are generated and
+    edits the message while the rest is generated, at most once per `interval` seconds.
+    Must be created in the event loop, `update` may be called from any thread.
+    """
+
+    def __init__(self, message, interval=1.0):
+        """
+        :param message: user message to reply to
+        :param interval: min seconds between the message edits
+        """
+        self.message = message
+        self.interval = interval
+        self.reply = None
+        self._text = None
+        self._sent_text = None
+        self._changed = asyncio.Event()
+        self._done = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        self._sender = asyncio.create_task(self._send_updates())
+
+    def update(self, text):
+        """Set the text generated so far."""
+        self._loop.call_soon_threadsafe(self._set_text, text)
+
+    def _set_text(self, text):
+        self._text = text
+        self._changed.set()
+
+    async def _send(self, text, reply_markup=None, model=''):
+        with STAGE_SECONDS.time(stage='telegram_send', model=model, kind='text'):
+            if self.reply is None:
+                self.reply = await self.message.reply_text(
+                    text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+            elif text != self._sent_text or reply_markup is not None:
+                await self.reply.edit_text(
+                    text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+        self._sent_text = text
+
+    async def _send_updates(self):
+        while True:
+            await self._changed.wait()
+            if self._done.is_set():
+                return
+            self._changed.clear()
+            try:
+                await self._send(self._text)
+            except telegram.error.TelegramError as e:
+                logger.warning('Failed to send the partial answer: %s', e)
+            try:
+                await asyncio.wait_for(self._done.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self):
+        self._done.set()
+        self._changed.set()
+        await self._sender
+
+    async def finish(self, text, reply_markup, model=''):
+        """Stop sending the updates and set the final text of the answer."""
+        await self.stop()
+        await self._send(text, reply_markup, model)
 
 
 @send_typing_action
-def text_handler(update, context):
-    question = update.message.text
-    general_joke_handler(update, context, question)
+async def joke_command_handler(update, context):
+    await general_joke_handler(update, context, promt_text="")
 
 
-def general_joke_handler(update, context, promt_text=""):
-    joke = joke_generator.generate_joke(promt=promt_text)
+@send_typing_action
+async def text_handler(update, context):
+    question = update.message.text
+    await general_joke_handler(update, context, question)
+
+
+async def general_joke_handler(update, context, promt_text=""):
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        outcome = await answer_joke(update, promt_text)
+    finally:
+        REQUEST_SECONDS.observe(time.perf_counter() - start,
+                                kind='text' if promt_text else 'joke', outcome=outcome)
+
+
+async def answer_joke(update, promt_text=""):
+    """Reply with the joke.
+
+    :return: outcome of the request for the metrics
+    """
+    if not joke_generator.ready.is_set():
+        await update.message.reply_text(warming_up_text)
+        return 'warming_up'
+    stream = None
+    if promt_text and stream_answers:
+        stream = StreamingReply(update.message, stream_update_interval)
+    try:
+        joke = await inference.run(joke_generator.generate_joke, promt=promt_text,
+                                   on_update=stream.update if stream else None)
+    except (Busy, asyncio.TimeoutError) as e:
+        if stream is not None:
+            await stream.stop()
+        await update.message.reply_text(busy_text if isinstance(e, Busy) else timeout_text)
+        return 'busy' if isinstance(e, Busy) else 'timeout'
+    except Exception:
+        if stream is not None:
+            await stream.stop()
+        raise
     joke_id = joke.id
 
     keyboard = [[InlineKeyboardButton("👍", callback_data=f'{joke_id}{splitter}{pos}'),
@@ -72,50 +202,80 @@ def general_joke_handler(update, context, promt_text=""):
 
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    update.message.reply_text(
-        joke.text, reply_markup=reply_markup, parse_mode=telegram.ParseMode.HTML)
+    if stream is not None:
+        await stream.finish(joke.text, reply_markup, joke.generated_by)
+    else:
+        with STAGE_SECONDS.time(stage='telegram_send', model=joke.generated_by,
+                                kind='text' if promt_text else 'joke'):
+            await update.message.reply_text(
+                joke.text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+    return 'ok'
 
 
-def button_handler(update, context):
+async def button_handler(update, context):
     query = update.callback_query
     data = query.data
     (joke_id, rating) = data.rsplit(splitter, 1)
     user_id = query.message.chat.id
+    loop = asyncio.get_running_loop()
+    # Votes are not limited by the inference executor
     if rating == pos:
-        joke_generator.positive_grade(user_id=user_id, joke_id=joke_id)
+        await loop.run_in_executor(None, lambda: joke_generator.positive_grade(user_id=user_id, joke_id=joke_id))
     elif rating == neg:
-        joke_generator.negative_grade(user_id=user_id, joke_id=joke_id)
-    context.bot.answer_callback_query(query.id, "Thank you for your feedback")
+        await loop.run_in_executor(None, lambda: joke_generator.negative_grade(user_id=user_id, joke_id=joke_id))
+    await context.bot.answer_callback_query(query.id, "Thank you for your feedback")
 
 
-def start(update, context):
-    update.message.reply_text("Use /joke to generate a joke")
+async def start(update, context):
+    await update.message.reply_text("Use /joke to generate a joke")
 
 
-def error(update, context):
+async def error(update, context):
     """Log Errors caused by Updates."""
     logger.warning('Update "%s" caused error "%s"', update, context.error)
 
 
 def main():
-    # Create the Updater and pass it your bot's token.
-    # Make sure to set use_context=True to use the new context based callbacks
-    # Post version 12 this will no longer be necessary
-    updater = Updater(cfg['bot']['token'], use_context=True)
-
-    updater.dispatcher.add_handler(CommandHandler('joke', joke_command_handler))
-    updater.dispatcher.add_handler(CallbackQueryHandler(button_handler))
-    updater.dispatcher.add_handler(CommandHandler('start', start))
-    updater.dispatcher.add_handler(CallbackQueryHandler(text_handler))
-    updater.dispatcher.add_error_handler(error)
-    updater.dispatcher.add_handler(MessageHandler(Filters.text, text_handler))
-
-    # Start the Bot
-    updater.start_polling()
+    global joke_generator, inference
+    # Not done on import, the model worker processes import this module again
+    storage.init()
+    # Returns right away with background_startup, the bot polls
+    # while the models are loaded
+    joke_generator = create_joke_generator()
+    # Generation runs in the bounded executor, so the event loop keeps
+    # serving updates and rejects the new ones when the queue is full
+    inference = InferenceExecutor(max_in_flight=int(cfg['bot']['max_in_flight']),
+                                  max_queue=int(cfg['bot']['max_queue']),
+                                  timeout=float(cfg['bot']['inference_timeout']))
+    QUEUE_DEPTH.add_function(lambda: [({'queue': 'inference'}, inference.pending)])
+    metrics_port = int(cfg['bot']['metrics_port'])
+    if metrics_port:
+        try:
+            start_http_server(metrics_port)
+        except OSError as e:
+            # E.g. the port is taken, the bot keeps answering without the metrics
+            logger.warning('Failed to serve the metrics on port %d, running without them: %s', metrics_port, e)
+
+    # Updates are handled concurrently, so concurrent questions
+    # can be batched together by the generator
+    application = Application.builder().token(cfg['bot']['token']).concurrent_updates(True).build()
+
+    application.add_handler(CommandHandler('joke', joke_command_handler))
+    application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(CommandHandler('start', start))
+    application.add_handler(CallbackQueryHandler(text_handler))
+    application.add_error_handler(error)
+    application.add_handler(MessageHandler(filters.TEXT, text_handler))
 
     # Run the bot until the user presses Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT
-    updater.idle()
+    application.run_polling()
+    # The unserved jokes are served after the restart instead of generating them again
+    if joke_generator.ready.is_set():
+        joke_generator.save_jokes_pools()
+    # Stops the worker processes of the models
+    joke_generator.close()
+    inference.shutdown()
 
 
 if __name__ == '__main__':
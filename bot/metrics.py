@@ -0,0 +1,193 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds, from the tokenization of a prompt up to the whole generation
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Registry:
+    """Metrics rendered together in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = list()
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self.metrics)
+        lines = list()
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = dict()
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {value}'
+                for key, value in sorted(values.items())]
+
+
+class Gauge(_Metric):
+    """Gauge set directly or read from the functions when rendered."""
+    type = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._functions = list()
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def add_function(self, function):
+        """Add the function returning the list of (labels dict, value) read on every render."""
+        with self._lock:
+            self._functions.append(function)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = list(self._functions)
+        for function in functions:
+            try:
+                values.update((self._key(labels), value) for labels, value in function())
+            except Exception as e:
+                print(f'[ERROR] metrics - {self.name}: {e!r}')
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {value}'
+                for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, (None, 0.0))
+            if counts is None:
+                # The last one counts the values above all the buckets
+                counts = [0] * (len(self.buckets) + 1)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        lines = list()
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, [("le", le)])} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}')
+        return lines
+
+
+# Metrics of the serving path. Stages: tokenize, prefill, generate, decode
+# (in `ModelWrapper`, not recorded by the worker processes of `ModelWorkerPool`),
+# prettify, storage_write, storage_commit and telegram_send
+STAGE_SECONDS = Histogram('joke_stage_seconds', 'Time spent in the stage of the request',
+                          ['stage', 'model', 'kind'])
+REQUEST_SECONDS = Histogram('joke_request_seconds', 'Time to answer the Telegram update',
+                            ['kind', 'outcome'])
+BUFFER_POPS = Counter('joke_buffer_pops_total', 'Jokes taken from the pools, right away or after waiting',
+                      ['model', 'result'])
+RESPONSE_CACHE_LOOKUPS = Counter('joke_response_cache_lookups_total',
+                                 'Typed prompts looked up in the response cache', ['model', 'result'])
+RESPONSE_CACHE_SIZE = Gauge('joke_response_cache_size', 'Number of prompts in the response cache')
+POOL_SIZE = Gauge('joke_pool_size', 'Number of pre-generated jokes in the pool', ['model'])
+QUEUE_DEPTH = Gauge('joke_queue_depth', 'Number of requests waiting in the queue', ['queue'])
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, host='127.0.0.1', registry=REGISTRY):
+    """Serve the metrics on http://host:port/metrics from a background thread."""
+    handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+    print(f'[INFO] metrics - serving on http://{host}:{port}/metrics')
+    return server
@@ -0,0 +1,121 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+class _Entry:
+    def __init__(self):
+        self.answers = list()
+        self.next = 0
+        self.pending = 0
+        self.created = time.monotonic()
+
+
+class ResponseCache:
+    """LRU cache with TTL of the answers generated for user prompts.
+
+    Keeps a small pool of answers for each model and normalized prompt,
+    served round-robin, so popular questions don't call the model at all.
+    """
+
+    def __init__(self, max_size=1024, ttl=3600, answers_per_prompt=4):
+        """
+        :param max_size: max number of prompts in the cache
+        :param ttl: seconds after which the prompt answers are dropped
+        :param answers_per_prompt: size of the answers pool of each prompt
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.answers_per_prompt = answers_per_prompt
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(prompt):
+        """Lowercase the prompt, drop punctuation and extra whitespaces."""
+        return ' '.join(re.sub(r'[^\w\s]', ' ', prompt.lower()).split())
+
+    def _key(self, prompt, model):
+        # The answers of different models are never mixed, so they are rated as the right one
+        return model, self.normalize(prompt)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get_entry(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry.created > self.ttl:
+            del self._entries[key]
+            entry = None
+        return entry
+
+    def get(self, prompt, model=None):
+        """Get the next cached answer for the prompt.
+
+        :param model: (optional) name of the model the answer is generated by
+        :return: copy of the answer dict or None if there is none
+        """
+        key = self._key(prompt, model)
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry is None or not entry.answers:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            answer = entry.answers[entry.next % len(entry.answers)]
+            entry.next += 1
+            return dict(answer)
+
+    def add(self, prompt, answer, pending=False, model=None):
+        """Add the answer to the prompt pool if it is not full.
+
+        :param pending: whether the answer was reserved with `reserve`
+        :param model: (optional) name of the model the answer is generated by
+        """
+        key = self._key(prompt, model)
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry()
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+            elif pending:
+                entry.pending = max(entry.pending - 1, 0)
+            if len(entry.answers) < self.answers_per_prompt:
+                entry.answers.append(dict(answer))
+
+    def reserve(self, prompt, model=None):
+        """Reserve the answers missing in the prompt pool to generate them.
+
+        :return: number of answers to generate
+        """
+        key = self._key(prompt, model)
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry is None:
+                return 0
+            missing = self.answers_per_prompt - len(entry.answers) - entry.pending
+            missing = max(missing, 0)
+            entry.pending += missing
+            return missing
+
+    def release(self, prompt, model=None):
+        """Release the reserved answer which failed to generate."""
+        key = self._key(prompt, model)
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry is not None:
+                entry.pending = max(entry.pending - 1, 0)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
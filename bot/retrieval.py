@@ -0,0 +1,100 @@
+import re
+from collections import Counter
+
+import numpy as np
+
+
+class RetrievalIndex:
+    """Nearest neighbour search of the dataset jokes by their questions.
+
+    Questions are TF-IDF vectors of hashed words, word bigrams and character
+    trigrams, compared by cosine similarity. The vectors are kept as an
+    inverted index, so the search only touches the jokes sharing n-grams
+    with the query.
+    """
+
+    question_pattern = re.compile(r'\[QUESTION\]\s*(.*?)\s*\n\[ANSWER\]', re.S)
+
+    def __init__(self, datasets, num_buckets=2 ** 20, min_similarity=0.1):
+        """
+        :param datasets: list of `joke_generator.Dataset` to index
+        :param num_buckets: number of the n-gram hash buckets
+        :param min_similarity: min cosine similarity of the questions to answer with the joke
+        """
+        self.num_buckets = num_buckets
+        self.min_similarity = min_similarity
+        self.datasets = datasets
+        # Index of the first joke of every dataset
+        self.offsets = np.cumsum([0] + [len(dataset) for dataset in datasets])
+
+        rows, buckets, counts = list(), list(), list()
+        doc = 0
+        for dataset in datasets:
+            for idx in range(len(dataset)):
+                match = self.question_pattern.match(dataset[idx]['text'])
+                features = Counter(self._features(match.group(1) if match else ''))
+                rows.extend([doc] * len(features))
+                buckets.extend(features.keys())
+                counts.extend(features.values())
+                doc += 1
+        self.num_docs = doc
+        rows = np.asarray(rows, dtype=np.int64)
+        buckets = np.asarray(buckets, dtype=np.int64)
+
+        doc_freq = np.bincount(buckets, minlength=num_buckets)
+        self.idf = (np.log((1 + self.num_docs) / (1 + doc_freq)) + 1).astype(np.float32)
+        weights = (1 + np.log(np.asarray(counts, dtype=np.float32))) * self.idf[buckets]
+        norms = np.sqrt(np.bincount(rows, weights=weights * weights, minlength=self.num_docs))
+        weights /= np.maximum(norms[rows], 1e-12)
+
+        # Postings of the bucket b are docs[bucket_starts[b]:bucket_starts[b + 1]]
+        order = np.argsort(buckets, kind='stable')
+        self.docs = rows[order]
+        self.weights = weights[order].astype(np.float32)
+        self.bucket_starts = np.searchsorted(buckets[order], np.arange(num_buckets + 1))
+
+    def _features(self, text):
+        """Hash buckets of the words, word bigrams and character trigrams of the text."""
+        words = re.sub(r'[^\w\s]', ' ', text.lower()).split()
+        features = words + [f'{a} {b}' for a, b in zip(words, words[1:])]
+        for word in words:
+            padded = f' {word} '
+            features.extend(f'#{padded[i:i + 3]}' for i in range(len(padded) - 2))
+        return [hash(feature) % self.num_buckets for feature in features]
+
+    def nearest(self, text):
+        """Find the joke with the question most similar to the text.
+
+        :return: (joke index, cosine similarity), (None, 0.0) if no joke shares any n-gram
+        """
+        features = Counter(self._features(text))
+        if not features or not self.num_docs:
+            return None, 0.0
+        buckets = np.fromiter(features.keys(), dtype=np.int64, count=len(features))
+        query = (1 + np.log(np.fromiter(features.values(), dtype=np.float32, count=len(features))))
+        query *= self.idf[buckets]
+        query /= max(np.linalg.norm(query), 1e-12)
+
+        starts, ends = self.bucket_starts[buckets], self.bucket_starts[buckets + 1]
+        docs = np.concatenate([self.docs[s:e] for s, e in zip(starts, ends)])
+        if not len(docs):
+            return None, 0.0
+        weights = np.concatenate([self.weights[s:e] * w for s, e, w in zip(starts, ends, query)])
+        scores = np.bincount(docs, weights=weights, minlength=self.num_docs)
+        best = int(scores.argmax())
+        return best, float(scores[best])
+
+    def answer(self, text):
+        """Get the joke with the question most similar to the text.
+
+        :return: joke dict with 'generated_by' tagged as 'retrieval:<dataset>'
+        or None if no question is similar enough
+        """
+        idx, similarity = self.nearest(text)
+        if idx is None or similarity < self.min_similarity:
+            return None
+        dataset_idx = int(np.searchsorted(self.offsets, idx, side='right')) - 1
+        dataset = self.datasets[dataset_idx]
+        joke = dataset[idx - int(self.offsets[dataset_idx])]
+        joke['generated_by'] = f'retrieval:{dataset.name}'
+        return joke
@@ -0,0 +1,53 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Busy(Exception):
+    """Raised when too many inference calls are already waiting."""
+
+
+class InferenceExecutor:
+    """Runs blocking joke generation calls for asyncio handlers in a bounded thread pool.
+
+    At most `max_in_flight` calls run at once and at most `max_queue`
+    more wait for their turn, calls beyond that are rejected with `Busy`.
+    Must be used from the thread running the event loop.
+    """
+
+    def __init__(self, max_in_flight=8, max_queue=32, timeout=60.0):
+        """
+        :param max_in_flight: max number of calls running at once
+        :param max_queue: max number of calls waiting to run
+        :param timeout: seconds the caller waits for the result
+        """
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.timeout = timeout
+        # Running and waiting calls, including the ones the caller stopped waiting for
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(max_in_flight, thread_name_prefix='inference')
+
+    def _on_done(self, future):
+        self.pending -= 1
+        if not future.cancelled():
+            # Mark the exception of the abandoned call as retrieved
+            future.exception()
+
+    async def run(self, func, *args, **kwargs):
+        """Run the function in the pool and wait for the result.
+
+        :raises Busy: when the queue is full
+        :raises asyncio.TimeoutError: when the result is not ready in `timeout` seconds,
+        the call still finishes in the background
+        """
+        if self.pending >= self.max_in_flight + self.max_queue:
+            raise Busy()
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+        self.pending += 1
+        future.add_done_callback(self._on_done)
+        return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
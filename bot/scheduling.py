@@ -0,0 +1,105 @@
+import random
+import threading
+from abc import ABC, abstractmethod
+
+
+class PoolScheduler(ABC):
+    """Chooses the source of the next joke keeping the target traffic split.
+
+    Counts the jokes served by every source to report the drift
+    of the actual split from the target one.
+    """
+
+    def __init__(self, weights, report_every=1000):
+        """
+        :param weights: dict of source name to its share of the traffic,
+        the shares are normalized
+        :param report_every: print the split every this number of jokes, 0 to disable
+        """
+        total = sum(weights.values())
+        if total <= 0:
+            raise ValueError('The traffic split weights should sum to a positive number')
+        self.target = {name: weight / total for name, weight in weights.items()}
+        self.served = dict.fromkeys(self.target, 0)
+        self.total = 0
+        self.report_every = report_every
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def _choose(self, ready):
+        """Choose the source.
+
+        :param ready: dict of source name to whether it can serve the joke right away
+        :return: source name
+        """
+        pass
+
+    def pick(self, ready):
+        """Choose the source of the next joke and count it as served.
+
+        :param ready: dict of source name to whether it can serve the joke right away
+        :return: source name
+        """
+        with self._lock:
+            name = self._choose(ready)
+            self.served[name] += 1
+            self.total += 1
+            report = self.report_every and self.total % self.report_every == 0
+        if report:
+            self.report()
+        return name
+
+    def deficit(self, name):
+        """Number of jokes the source is behind its target share."""
+        return self.target[name] * self.total - self.served[name]
+
+    def drift(self):
+        """Actual minus target share of the traffic of every source."""
+        return {name: (self.served[name] / self.total if self.total else 0.0) - target
+                for name, target in self.target.items()}
+
+    def report(self):
+        drift = self.drift()
+        for name, target in self.target.items():
+            print(f'[INFO] split - {name}: target {target:.3f}, drift {drift[name]:+.3f}, '
+                  f'served {self.served[name]}')
+
+
+class RandomScheduler(PoolScheduler):
+    """Chooses the source at random with the target probabilities, ignores readiness."""
+
+    def _choose(self, ready):
+        names = list(self.target)
+        return random.choices(names, weights=[self.target[name] for name in names])[0]
+
+
+class ReadyFirstScheduler(PoolScheduler):
+    """Serves the source furthest behind its target share among the ready ones.
+
+    A source that isn't ready falls behind and is served first once it is ready again,
+    unless it is behind by more than `max_lag` jokes, then it is served anyway.
+    """
+
+    def __init__(self, weights, report_every=1000, max_lag=8):
+        """
+        See `PoolScheduler` for the other parameters.
+
+        :param max_lag: max number of jokes the source may fall behind its target share
+        """
+        super().__init__(weights, report_every)
+        self.max_lag = max_lag
+
+    def _choose(self, ready):
+        # Jitter below one joke randomizes the order of the sources equally behind
+        deficits = {name: self.deficit(name) + random.random() for name in self.target}
+        lagging = max(deficits, key=deficits.get)
+        candidates = [name for name in deficits if ready.get(name)]
+        if not candidates or deficits[lagging] > self.max_lag:
+            return lagging
+        return max(candidates, key=deficits.get)
+
+
+SCHEDULERS = {
+    'random': RandomScheduler,
+    'ready': ReadyFirstScheduler,
+}
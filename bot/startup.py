@@ -0,0 +1,40 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class StartupTimer:
+    """Collects the durations of the startup phases, which may run in parallel."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = list()
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            self.phases.append((name, seconds))
+
+    def since_start(self, name):
+        """Record the phase which began together with the startup.
+
+        :return: its duration in seconds
+        """
+        seconds = time.perf_counter() - self.started
+        self.record(name, seconds)
+        return seconds
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def report(self):
+        with self._lock:
+            phases = list(self.phases)
+        for name, seconds in phases:
+            print(f'[INFO] startup - {name}: {seconds:.2f} s')
+        print(f'[INFO] startup - total: {time.perf_counter() - self.started:.2f} s')
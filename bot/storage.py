@@ -1,9 +1,22 @@
+import atexit
 import datetime
+import itertools
+import math
+import queue
+import threading
+import time
+from collections import deque
 
 from peewee import *
 
-db = SqliteDatabase('jokes.db')
+from metrics import QUEUE_DEPTH, STAGE_SECONDS
+
+# Opened by `init`
+db = SqliteDatabase(None)
 default_generated = "unknown"
+# Started by `init`
+writer = None
+_joke_ids = None
 
 class BaseModel(Model):
     class Meta:
@@ -14,38 +27,270 @@ class Joke(BaseModel):
     joke_id = AutoField()
     text = CharField(max_length=1024)
     created_date = DateTimeField(default=datetime.datetime.now)
-    generated_by = CharField(max_length=128, default=default_generated)
+    generated_by = CharField(max_length=128, default=default_generated, index=True)
 
 
 class Vote(BaseModel):
     joke = ForeignKeyField(Joke, backref='votes')
-    user_id = CharField()
+    user_id = CharField(index=True)
     rate = IntegerField(default=0)
 
     class Meta:
         primary_key = CompositeKey('joke', 'user_id')
 
 
-def add_joke(text, generated_by=default_generated):
+class ModelRating(BaseModel):
+    """Votes of the jokes of one source, updated together with the votes."""
+    generated_by = CharField(max_length=128, primary_key=True)
+    votes = IntegerField(default=0)
+    positives = IntegerField(default=0)
+    negatives = IntegerField(default=0)
+    rate_sum = IntegerField(default=0)
+
+
+class PooledJoke(BaseModel):
+    """Pre-generated joke not served before the bot stopped."""
+    model_name = CharField(max_length=128, index=True)
+    fingerprint = CharField(max_length=64)
+    text = CharField(max_length=1024)
+    generated_by = CharField(max_length=128, default=default_generated)
+
+
+class StorageWriter(threading.Thread):
+    """Background writer inserting the queued jokes and votes in batched transactions."""
+
+    def __init__(self, max_batch_size=256, max_delay=0.05):
+        """
+        :param max_batch_size: max number of rows written in one transaction
+        :param max_delay: max seconds the row waits for the rest of the batch
+        """
+        super().__init__(name='StorageWriter', daemon=True)
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        # Seconds from queueing to commit of the recently written rows
+        self.latencies = deque(maxlen=10000)
+        self._queue = queue.Queue()
+
+    def put(self, table, row):
+        """Queue the row for the insert into `Joke` or upsert into `Vote` table."""
+        self._queue.put((table, row, time.perf_counter()))
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def flush(self):
+        """Wait until all the queued rows are written."""
+        self._queue.join()
+
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        try:
+            while len(batch) < self.max_batch_size:
+                batch.append(self._queue.get(timeout=self.max_delay))
+        except queue.Empty:
+            pass
+        return batch
+
+    @staticmethod
+    def _rating_changes(jokes, votes):
+        """Changes of `ModelRating` counters made by the votes,
+        the previous votes of the same users are taken back.
+
+        :return: dict of generated_by to [votes, positives, negatives, rate_sum] changes
+        """
+        keys = {(vote['joke'], vote['user_id']) for vote in votes}
+        joke_ids = {joke_id for joke_id, _ in keys}
+        sources = {joke['joke_id']: joke['generated_by'] for joke in jokes}
+        query = Joke.select(Joke.joke_id, Joke.generated_by).where(
+            Joke.joke_id.in_(list(joke_ids - set(sources))))
+        sources.update((joke.joke_id, joke.generated_by) for joke in query)
+        previous = {(vote.joke_id, vote.user_id): vote.rate for vote in Vote.select().where(
+            Vote.joke.in_(list(joke_ids)) & Vote.user_id.in_([user_id for _, user_id in keys]))}
+
+        changes = dict()
+        for vote in votes:
+            key = (vote['joke'], vote['user_id'])
+            change = changes.setdefault(sources.get(vote['joke'], default_generated), [0, 0, 0, 0])
+            for rate, sign in ((previous.get(key), -1), (vote['rate'], 1)):
+                if rate is not None:
+                    change[0] += sign
+                    change[1] += sign * (rate > 0)
+                    change[2] += sign * (rate < 0)
+                    change[3] += sign * rate
+            previous[key] = vote['rate']
+        return changes
+
+    def _write_batch(self, batch):
+        jokes = [row for table, row, _ in batch if table is Joke]
+        votes = [row for table, row, _ in batch if table is Vote]
+        # Jokes first, so the votes never refer to the missing jokes.
+        # Later votes of the same user replace the earlier ones.
+        with db.atomic():
+            if jokes:
+                Joke.insert_many(jokes).execute()
+            if votes:
+                update_ratings(self._rating_changes(jokes, votes))
+                # https://stackoverflow.com/questions/33485312/insert-or-update-a-peewee-record-in-python
+                Vote.insert_many(votes).on_conflict('replace').execute()
+
+    def run(self):
+        while True:
+            batch = self._collect_batch()
+            try:
+                with STAGE_SECONDS.time(stage='storage_commit', model='', kind='batch'):
+                    self._write_batch(batch)
+                now = time.perf_counter()
+                self.latencies.extend(now - queued for _, _, queued in batch)
+            except Exception as e:
+                print(f'[ERROR] storage - failed to write {len(batch)} rows: {e!r}')
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+
+def init(path='jokes.db'):
+    """Open the database, create the missing tables and start the background writer.
+
+    Called by the process serving the bot, not on import: the model worker
+    processes import the bot modules too and must not open the database.
+    Does nothing if the storage is already initialized.
+
+    :param path: path to the SQLite database file
     """
+    global _joke_ids, writer
+    if writer is not None:
+        return
+    # WAL lets the handlers read while the writer commits,
+    # synchronous=normal doesn't fsync on every commit in WAL mode
+    db.init(path, pragmas={
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'cache_size': -16 * 1024,  # 16 MB
+        'temp_store': 'memory',
+    })
+    db.connect()
+    db.create_tables([Joke, Vote, PooledJoke, ModelRating])  # Don't deletes prev data
+    # Ratings table added to the database with the votes
+    if not ModelRating.select().exists() and Vote.select().exists():
+        rebuild_ratings()
+
+    # Only this process writes the jokes, so the ids are handed out from memory
+    _joke_ids = itertools.count((Joke.select(fn.MAX(Joke.joke_id)).scalar() or 0) + 1)
+    writer = StorageWriter()
+    writer.start()
+    QUEUE_DEPTH.add_function(lambda: [({'queue': 'storage'}, writer.qsize())])
+    atexit.register(writer.flush)
+
+
+def add_joke(text, generated_by=default_generated):
+    """The joke is written in the background, its id is assigned right away.
+
     :param generated_by: where this joke came from - modelA/modelB/datasetA...
     :param text: text of joke
     :return: id of registered joke
     """
-    joke = Joke.create(text=text, generated_by=generated_by)
-    return joke.joke_id
+    joke_id = next(_joke_ids)
+    writer.put(Joke, {'joke_id': joke_id, 'text': text, 'generated_by': generated_by,
+                      'created_date': datetime.datetime.now()})
+    return joke_id
 
 
 def add_or_update_vote(joke_id, user_id, rating):
-    # https://stackoverflow.com/questions/33485312/insert-or-update-a-peewee-record-in-python
-    Vote.insert(joke_id=joke_id, user_id=user_id, rate=rating).on_conflict('replace').execute()
+    """The vote is written in the background.
+
+    :param joke_id: id of the joke, the callback data gives it as a string
+    :param user_id: id of the user, kept as a string like in `Vote`
+    """
+    # The same types as read from the database, the queued votes are matched with the stored ones
+    writer.put(Vote, {'joke': int(joke_id), 'user_id': str(user_id), 'rate': rating})
+
+
+def update_ratings(changes):
+    """Add the changes to `ModelRating` counters.
+
+    :param changes: dict of generated_by to [votes, positives, negatives, rate_sum] changes
+    """
+    fields = [ModelRating.votes, ModelRating.positives, ModelRating.negatives, ModelRating.rate_sum]
+    for generated_by, change in changes.items():
+        row = {field.name: value for field, value in zip(fields, change)}
+        ModelRating.insert(generated_by=generated_by, **row).on_conflict(
+            conflict_target=[ModelRating.generated_by],
+            update={field: field + EXCLUDED[field.name] for field in fields}).execute()
+
+
+def rebuild_ratings():
+    """Recompute `ModelRating` from all the votes."""
+    query = (Vote.select(Joke.generated_by,
+                         fn.COUNT(Vote.rate),
+                         fn.SUM(Case(None, [(Vote.rate > 0, 1)], 0)),
+                         fn.SUM(Case(None, [(Vote.rate < 0, 1)], 0)),
+                         fn.SUM(Vote.rate))
+             .join(Joke).group_by(Joke.generated_by).tuples())
+    with db.atomic():
+        ModelRating.delete().execute()
+        update_ratings({row[0]: row[1:] for row in query})
 
 
-db.connect()
-db.create_tables([Joke, Vote])  # Don't deletes prev data
+def get_ratings(z=1.96):
+    """Ratings of all the joke sources, best first.
+
+    :param z: z-score of the confidence level, 1.96 for 95%
+    :return: list of dicts with 'generated_by', 'votes', 'positives', 'negatives',
+    'mean' rate and Wilson score confidence interval of the positive
+    votes share ('positive_low', 'positive_high')
+    """
+    ratings = list()
+    for rating in ModelRating.select():
+        n = rating.votes
+        share = rating.positives / n if n else 0.0
+        center = (share + z * z / (2 * n)) / (1 + z * z / n) if n else 0.0
+        margin = (z * math.sqrt(share * (1 - share) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+                  if n else 0.0)
+        ratings.append({
+            'generated_by': rating.generated_by,
+            'votes': n,
+            'positives': rating.positives,
+            'negatives': rating.negatives,
+            'mean': rating.rate_sum / n if n else 0.0,
+            'positive_low': max(center - margin, 0.0),
+            'positive_high': min(center + margin, 1.0),
+        })
+    return sorted(ratings, key=lambda rating: rating['positive_low'], reverse=True)
+
+
+def save_pooled_jokes(model_name, fingerprint, jokes):
+    """Replace the saved jokes pool of the model.
+
+    :param fingerprint: fingerprint of the model checkpoint the jokes were generated by
+    :param jokes: list of dicts with 'text' and 'generated_by' fields
+    """
+    with db.atomic():
+        PooledJoke.delete().where(PooledJoke.model_name == model_name).execute()
+        if jokes:
+            PooledJoke.insert_many([
+                {'model_name': model_name, 'fingerprint': fingerprint,
+                 'text': joke['text'], 'generated_by': joke['generated_by']}
+                for joke in jokes]).execute()
+
+
+def pop_pooled_jokes(model_name, fingerprint):
+    """Take the saved jokes pool of the model out of the database.
+    Jokes generated by other checkpoints are dropped.
+
+    :return: list of dicts with 'text' and 'generated_by' fields
+    """
+    with db.atomic():
+        query = PooledJoke.select().where((PooledJoke.model_name == model_name)
+                                          & (PooledJoke.fingerprint == fingerprint))
+        jokes = [{'text': joke.text, 'generated_by': joke.generated_by}
+                 for joke in query.order_by(PooledJoke.id)]
+        PooledJoke.delete().where(PooledJoke.model_name == model_name).execute()
+    return jokes
+
 
 if __name__ == '__main__':
     # Use case
+    init()
     for _ in range(3):
         joke = Joke.create(text="kekv")
         for v in range(5, 10):
@@ -0,0 +1,172 @@
+import itertools
+import threading
+from concurrent.futures import Future
+
+import multiprocessing.connection as mp_connection
+
+import torch
+import torch.multiprocessing as mp
+
+from inference import ModelWrapper
+
+
+def _worker_loop(model, num_threads, requests, results):
+    """Serve generation requests in the worker process."""
+    torch.set_num_threads(num_threads)
+    while True:
+        item = requests.get()
+        if item is None:
+            break
+        request_id, method, args = item
+        try:
+            results.put((request_id, getattr(model, method)(*args), None))
+        except Exception as e:
+            results.put((request_id, None, repr(e)))
+
+
+class ModelWorkerPool:
+    """Runs the `ModelWrapper` generation in a pool of processes.
+
+    The weights are moved to shared memory once, so all the workers
+    use the same read-only copy instead of loading their own.
+    Has the same generation interface as `ModelWrapper`.
+
+    Every worker has its own queue of requests. When a worker dies, the
+    requests sent to it fail with `RuntimeError` and the worker is restarted.
+    """
+
+    def __init__(self, model, num_workers=2, threads_per_worker=None):
+        """
+        :param model: loaded `ModelWrapper` to share with the workers
+        :param num_workers: number of worker processes
+        :param threads_per_worker: (optional) torch threads of each worker,
+        by default the cores are split evenly between the workers
+        """
+        if not threads_per_worker:
+            threads_per_worker = max(torch.get_num_threads() // num_workers, 1)
+        self.model = model
+        self.name = model.name
+        self.fingerprint = model.fingerprint
+        self.concurrency = num_workers
+        self.threads_per_worker = threads_per_worker
+        # Request id to (future, worker index)
+        self._futures = dict()
+        # Ids of the requests sent to every worker and not answered yet
+        self._assigned = [set() for _ in range(num_workers)]
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._closed = False
+
+        model.share_memory()
+        self._ctx = mp.get_context('spawn')
+        self._results = self._ctx.Queue()
+        self._requests = [None] * num_workers
+        self._workers = [None] * num_workers
+        for i in range(num_workers):
+            self._start_worker(i)
+        print(f'[INFO] worker pool - Model: {self.name}, workers: {num_workers}, '
+              f'threads per worker: {threads_per_worker}')
+        self._collector = threading.Thread(target=self._collect_results,
+                                           name=f'WorkerPool-{self.name}', daemon=True)
+        self._collector.start()
+        self._watcher = threading.Thread(target=self._watch_workers,
+                                         name=f'WorkerPoolWatcher-{self.name}', daemon=True)
+        self._watcher.start()
+
+    def _start_worker(self, i):
+        self._requests[i] = self._ctx.Queue()
+        self._workers[i] = self._ctx.Process(
+            target=_worker_loop, daemon=True,
+            args=(self.model, self.threads_per_worker, self._requests[i], self._results))
+        self._workers[i].start()
+
+    def _collect_results(self):
+        while True:
+            item = self._results.get()
+            if item is None:
+                break
+            request_id, result, error = item
+            with self._lock:
+                future, worker = self._futures.pop(request_id, (None, None))
+                if future is None:
+                    # Already failed
+                    continue
+                self._assigned[worker].discard(request_id)
+            if error is not None:
+                future.set_exception(RuntimeError(error))
+            else:
+                future.set_result(result)
+
+    def _watch_workers(self, poll_interval=1.0):
+        """Fail the requests of the dead workers and restart them."""
+        while not self._closed:
+            sentinels = {worker.sentinel: i for i, worker in enumerate(self._workers)}
+            for sentinel in mp_connection.wait(list(sentinels), timeout=poll_interval):
+                if self._closed:
+                    return
+                i = sentinels[sentinel]
+                self._workers[i].join()
+                exitcode = self._workers[i].exitcode
+                with self._lock:
+                    lost = [self._futures.pop(request_id)[0] for request_id in self._assigned[i]]
+                    self._assigned[i].clear()
+                    self._start_worker(i)
+                print(f'[ERROR] worker pool - Model: {self.name}, worker {i} died with exit code '
+                      f'{exitcode}, failed requests: {len(lost)}, restarted')
+                for future in lost:
+                    future.set_exception(RuntimeError(f'Worker of {self.name} died'))
+
+    def _call(self, method, *args):
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError(f'Worker pool of {self.name} is closed')
+            request_id = next(self._ids)
+            worker = min(range(len(self._workers)), key=lambda i: len(self._assigned[i]))
+            self._assigned[worker].add(request_id)
+            self._futures[request_id] = (future, worker)
+            self._requests[worker].put((request_id, method, args))
+        return future.result()
+
+    def generate(self, beginning, num_return_sequences=None):
+        return self._call('generate', beginning, num_return_sequences)
+
+    def generate_batch(self, beginnings, callbacks=None):
+        """Callbacks can't be sent to the workers, they are called once with the final text."""
+        sequences = self._call('generate_batch', beginnings)
+        for callback, text in zip(callbacks or [], sequences):
+            if callback is not None:
+                callback(text)
+        return sequences
+
+    def close(self, timeout=30):
+        """Stop the workers, the requests not answered by then fail."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._watcher.join()
+        for requests in self._requests:
+            requests.put(None)
+        for worker in self._workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+        self._results.put(None)
+        self._collector.join()
+        with self._lock:
+            lost = [future for future, _ in self._futures.values()]
+            self._futures.clear()
+        for future in lost:
+            future.set_exception(RuntimeError(f'Worker pool of {self.name} is closed'))
+
+
+def load_model(model_path, model_name, num_workers=1, threads_per_worker=None, **kwargs):
+    """Load the `ModelWrapper`, served by the pool of processes if `num_workers` > 1.
+
+    :param kwargs: arguments of `ModelWrapper`
+    """
+    model = ModelWrapper(model_path, model_name, **kwargs)
+    if num_workers > 1:
+        return ModelWorkerPool(model, num_workers, threads_per_worker)
+    return model
@@ -0,0 +1,33 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bot'))
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sys.modules.pop('storage', None)
+    module = importlib.import_module('storage')
+    module.init(str(tmp_path / 'jokes.db'))
+    yield module
+    module.writer.flush()
+    module.db.close()
+
+
+def test_flipped_vote_replaces_the_previous_one(storage):
+    joke_id = storage.add_joke('q: why?\na: because', generated_by='modelA')
+    # As given by `button_handler`: the joke id from the callback data, the user id of the chat
+    storage.add_or_update_vote(str(joke_id), 12345, 1)
+    storage.writer.flush()
+    storage.add_or_update_vote(str(joke_id), 12345, -1)
+    storage.writer.flush()
+
+    rating = storage.ModelRating.get(storage.ModelRating.generated_by == 'modelA')
+    assert (rating.votes, rating.positives, rating.negatives, rating.rate_sum) == (1, 0, 1, -1)
+    assert not storage.ModelRating.select().where(
+        storage.ModelRating.generated_by == storage.default_generated).exists()
+    assert storage.Vote.select().count() == 1
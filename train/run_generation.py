@@ -20,6 +20,8 @@
 
 import argparse
 import logging
+import os
+import sys
 
 import numpy as np
 import torch
@@ -39,6 +41,10 @@ from transformers import (
     XLNetTokenizer,
 )
 
+# The inference backends are shared with the bot
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "bot"))
+from backends import conv1d_to_linear  # noqa: E402
+
 
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s", datefmt="%m/%d/%Y %H:%M:%S", level=logging.INFO,
@@ -147,6 +153,20 @@ def adjust_length_to_model(length, max_sequence_length):
     return length
 
 
+#
+# CPU inference backends
+#
+
+
+def prepare_backend(args, model):
+    if args.backend == "int8":
+        model = conv1d_to_linear(model)
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    elif args.backend == "compile":
+        model.forward = torch.compile(model.forward, dynamic=True)
+    return model
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -186,6 +206,13 @@ def main():
     parser.add_argument("--seed", type=int, default=42, help="random seed for initialization")
     parser.add_argument("--no_cuda", action="store_true", help="Avoid using CUDA when available")
     parser.add_argument("--num_return_sequences", type=int, default=1, help="The number of samples to generate.")
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="eager",
+        choices=["eager", "int8", "compile"],
+        help="CPU inference backend: eager fp32, int8 dynamic quantization of the linear layers or torch.compile",
+    )
     args = parser.parse_args()
 
     args.device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
@@ -203,6 +230,7 @@ def main():
     tokenizer = tokenizer_class.from_pretrained(args.model_name_or_path)
     model = model_class.from_pretrained(args.model_name_or_path)
     model.to(args.device)
+    model = prepare_backend(args, model)
 
     args.length = adjust_length_to_model(args.length, max_sequence_length=model.config.max_position_embeddings)
     logger.info(args)
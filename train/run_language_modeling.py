@@ -21,19 +21,25 @@ using a masked language modeling (MLM) loss.
 
 
 import argparse
+import bisect
+import collections
 import glob
+import hashlib
+import json
 import logging
+import math
+import multiprocessing
 import os
-import pickle
 import random
 import re
 import shutil
+import time
 from typing import Dict, List, Tuple
 
 import numpy as np
 import torch
 from torch.nn.utils.rnn import pad_sequence
-from torch.utils.data import DataLoader, Dataset, RandomSampler, SequentialSampler
+from torch.utils.data import DataLoader, Dataset, RandomSampler, Sampler, SequentialSampler
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
 
@@ -62,6 +68,191 @@ logger = logging.getLogger(__name__)
 MODEL_CONFIG_CLASSES = list(MODEL_WITH_LM_HEAD_MAPPING.keys())
 MODEL_TYPES = tuple(conf.model_type for conf in MODEL_CONFIG_CLASSES)
 
+DOCUMENT_SEPARATOR = "<|endoftext|>"
+
+
+def split_documents(text: str, separator: str = DOCUMENT_SEPARATOR) -> List[str]:
+    """ Split the text into pieces tokenized independently: the documents and the separators between them.
+    Without separators, the text is split into lines before the newlines following a non-space character,
+    where the tokenizers split the words anyway. """
+    if separator in text:
+        pieces = re.split("(" + re.escape(separator) + ")", text)
+    else:
+        pieces = re.split(r"(?<=\S)(?=\n)", text)
+    return [piece for piece in pieces if piece]
+
+
+_worker_tokenizer = None
+
+
+def _init_tokenization_worker(tokenizer: PreTrainedTokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _tokenize_pieces(pieces: List[str]) -> List[List[int]]:
+    return [_worker_tokenizer.convert_tokens_to_ids(_worker_tokenizer.tokenize(piece)) for piece in pieces]
+
+
+def tokenize_documents(
+    tokenizer: PreTrainedTokenizer, documents: List[str], num_workers: int = 1, chunk_chars: int = 1 << 20
+) -> List[List[int]]:
+    """ Tokenize the documents in parallel and return the ids of the tokens of every document.
+
+    The documents are grouped into chunks of about `chunk_chars` characters, tokenized by a pool of
+    `num_workers` processes and merged in the order of the chunks, so the result doesn't depend
+    on the number of workers.
+    """
+    # At least a few chunks per worker to balance their load
+    chunk_chars = max(min(chunk_chars, sum(map(len, documents)) // (4 * num_workers)), 1)
+    chunks, chunk, chunk_len = [], [], 0
+    for document in documents:
+        chunk.append(document)
+        chunk_len += len(document)
+        if chunk_len >= chunk_chars:
+            chunks.append(chunk)
+            chunk, chunk_len = [], 0
+    if chunk:
+        chunks.append(chunk)
+
+    if num_workers <= 1 or len(chunks) <= 1:
+        _init_tokenization_worker(tokenizer)
+        tokenized_chunks = map(_tokenize_pieces, chunks)
+        return [ids for tokenized_chunk in tokenized_chunks for ids in tokenized_chunk]
+    with multiprocessing.Pool(min(num_workers, len(chunks)), _init_tokenization_worker, (tokenizer,)) as pool:
+        tokenized_chunks = pool.imap(_tokenize_pieces, chunks)
+        return [ids for tokenized_chunk in tokenized_chunks for ids in tokenized_chunk]
+
+
+def tokenize_corpus(tokenizer: PreTrainedTokenizer, text: str, num_workers: int = 1, chunk_chars: int = 1 << 20) -> List[int]:
+    """ Tokenize the corpus in parallel, see `tokenize_documents`, and return the ids of all its tokens. """
+    tokenized_pieces = tokenize_documents(tokenizer, split_documents(text), num_workers, chunk_chars)
+    return [token_id for ids in tokenized_pieces for token_id in ids]
+
+
+def benchmark_tokenization(tokenizer: PreTrainedTokenizer, file_path: str, max_workers: int = None) -> None:
+    """ Log the time to tokenize the file with 1, 2, 4, ... up to `max_workers` processes. """
+    with open(file_path, encoding="utf-8") as f:
+        text = f.read()
+    max_workers = max_workers or os.cpu_count()
+    reference, base_time = None, None
+    num_workers = 1
+    while True:
+        start = time.perf_counter()
+        tokenized_text = tokenize_corpus(tokenizer, text, num_workers)
+        elapsed = time.perf_counter() - start
+        if reference is None:
+            reference, base_time = tokenized_text, elapsed
+        assert tokenized_text == reference, "Tokenization depends on the number of workers"
+        logger.info(
+            "  %d workers: %.2f s, speedup %.2fx, %d tokens", num_workers, elapsed, base_time / elapsed, len(tokenized_text)
+        )
+        if num_workers >= max_workers:
+            break
+        num_workers = min(num_workers * 2, max_workers)
+
+
+TOKENS_CACHE_MAGIC = b"LMTOKS01"
+LINES_CACHE_MAGIC = b"LMLINE01"
+# Magic, then 3 uint64: number of blocks or lines, block length or total number of tokens,
+# and size in bytes of a token id
+TOKENS_CACHE_HEADER_SIZE = 32
+
+
+def file_fingerprint(file_path: str) -> str:
+    sha = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer: PreTrainedTokenizer) -> str:
+    """ Hash of the tokenizer class, vocabulary, merges and special tokens, which define the token ids. """
+    sha = hashlib.sha1(type(tokenizer).__name__.encode("utf-8"))
+    sha.update(json.dumps(tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))).encode("utf-8"))
+    bpe_ranks = getattr(tokenizer, "bpe_ranks", None)
+    if bpe_ranks:
+        sha.update(json.dumps(sorted(bpe_ranks, key=bpe_ranks.get)).encode("utf-8"))
+    sha.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True).encode("utf-8"))
+    return sha.hexdigest()
+
+
+def token_dtype(tokenizer: PreTrainedTokenizer) -> np.dtype:
+    return np.dtype(np.uint16 if len(tokenizer) <= 1 << 16 else np.uint32)
+
+
+def write_tokens_cache(path: str, blocks: np.ndarray):
+    """ Write the 2D array of token ids (uint16 or uint32) after the header. """
+    header = np.asarray([blocks.shape[0], blocks.shape[1], blocks.itemsize], dtype=np.uint64)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(TOKENS_CACHE_MAGIC)
+        f.write(header.tobytes())
+        f.write(np.ascontiguousarray(blocks).tobytes())
+    os.replace(tmp_path, path)
+
+
+def write_lines_cache(path: str, lines: List[List[int]], dtype: np.dtype):
+    """ Write the offsets of the lines (int64, number of lines + 1) and their token ids after the header. """
+    offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+    np.cumsum([len(line) for line in lines], out=offsets[1:])
+    header = np.asarray([len(lines), offsets[-1], dtype.itemsize], dtype=np.uint64)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(LINES_CACHE_MAGIC)
+        f.write(header.tobytes())
+        f.write(offsets.tobytes())
+        for line in lines:
+            f.write(np.asarray(line, dtype=dtype).tobytes())
+    os.replace(tmp_path, path)
+
+
+def _read_cache_header(path: str, magic: bytes) -> Tuple[int, int, np.dtype]:
+    with open(path, "rb") as f:
+        header = f.read(TOKENS_CACHE_HEADER_SIZE)
+    if header[: len(magic)] != magic:
+        raise ValueError("%s is not a tokens cache" % path)
+    size, length, itemsize = (int(n) for n in np.frombuffer(header[len(magic) :], np.uint64))
+    return size, length, np.dtype({2: np.int16, 4: np.int32}[itemsize])
+
+
+def _map_cache(path: str, dtype: np.dtype, offset: int, shape: Tuple[int, ...]) -> np.ndarray:
+    if not np.prod(shape):
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="c", offset=offset, shape=shape)
+
+
+def load_tokens_cache(path: str) -> np.ndarray:
+    """ Map the blocks written by `write_tokens_cache` to memory.
+
+    The ids are read as signed int16 or int32, which torch supports, see `as_token_ids`.
+    The mapping is copy-on-write, so the pages are shared by the processes until written.
+    """
+    num_blocks, block_len, dtype = _read_cache_header(path, TOKENS_CACHE_MAGIC)
+    return _map_cache(path, dtype, TOKENS_CACHE_HEADER_SIZE, (num_blocks, block_len))
+
+
+def load_lines_cache(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """ Map the offsets and the token ids written by `write_lines_cache` to memory, see `load_tokens_cache`. """
+    num_lines, num_tokens, dtype = _read_cache_header(path, LINES_CACHE_MAGIC)
+    offsets = _map_cache(path, np.int64, TOKENS_CACHE_HEADER_SIZE, (num_lines + 1,))
+    tokens = _map_cache(path, dtype, TOKENS_CACHE_HEADER_SIZE + offsets.nbytes, (num_tokens,))
+    return offsets, tokens
+
+
+def cache_key(tokenizer: PreTrainedTokenizer, file_path: str) -> str:
+    return hashlib.sha1((file_fingerprint(file_path) + tokenizer_fingerprint(tokenizer)).encode("utf-8")).hexdigest()[
+        :16
+    ]
+
+
+def as_token_ids(tokens: torch.Tensor) -> torch.Tensor:
+    """ Convert the tokens read from the cache to long token ids, the 16 bit ids are stored unsigned. """
+    if tokens.dtype == torch.int16:
+        return tokens.long() & 0xFFFF
+    return tokens.long()
+
 
 class TextDataset(Dataset):
     def __init__(self, tokenizer: PreTrainedTokenizer, args, file_path: str, block_size=512):
@@ -70,63 +261,272 @@ class TextDataset(Dataset):
         block_size = block_size - (tokenizer.max_len - tokenizer.max_len_single_sentence)
 
         directory, filename = os.path.split(file_path)
-        cached_features_file = os.path.join(
-            directory, args.model_type + "_cached_lm_" + str(block_size) + "_" + filename
+        self.cached_features_file = os.path.join(
+            directory,
+            args.model_type + "_cached_lm_" + str(block_size) + "_" + filename + "_" + cache_key(tokenizer, file_path) + ".bin",
         )
 
-        if os.path.exists(cached_features_file) and not args.overwrite_cache:
-            logger.info("Loading features from cached file %s", cached_features_file)
-            with open(cached_features_file, "rb") as handle:
-                self.examples = pickle.load(handle)
+        if os.path.exists(self.cached_features_file) and not args.overwrite_cache:
+            logger.info("Loading features from cached file %s", self.cached_features_file)
         else:
             logger.info("Creating features from dataset file at %s", directory)
 
-            self.examples = []
             with open(file_path, encoding="utf-8") as f:
                 text = f.read()
 
-            tokenized_text = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text))
+            tokenized_text = tokenize_corpus(tokenizer, text, args.preprocessing_num_workers)
 
-            for i in range(0, len(tokenized_text) - block_size + 1, block_size):  # Truncate in block of block_size
-                self.examples.append(tokenizer.build_inputs_with_special_tokens(tokenized_text[i : i + block_size]))
+            num_special_tokens = len(tokenizer.build_inputs_with_special_tokens([]))
+            examples = np.empty(
+                (len(tokenized_text) // block_size, block_size + num_special_tokens), dtype=token_dtype(tokenizer)
+            )
+            for n, i in enumerate(range(0, len(examples) * block_size, block_size)):  # Truncate in block of block_size
+                examples[n] = tokenizer.build_inputs_with_special_tokens(tokenized_text[i : i + block_size])
             # Note that we are loosing the last truncated example here for the sake of simplicity (no padding)
             # If your dataset is small, first you should loook for a bigger one :-) and second you
             # can change this behavior by adding (model specific) padding.
 
-            logger.info("Saving features into cached file %s", cached_features_file)
-            with open(cached_features_file, "wb") as handle:
-                pickle.dump(self.examples, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            logger.info("Saving features into cached file %s", self.cached_features_file)
+            write_tokens_cache(self.cached_features_file, examples)
+
+        self.examples = load_tokens_cache(self.cached_features_file)
 
     def __len__(self):
         return len(self.examples)
 
     def __getitem__(self, item):
-        return torch.tensor(self.examples[item], dtype=torch.long)
+        # View of the memory-mapped block, converted to long ids by `as_token_ids` when collated
+        return torch.from_numpy(self.examples[item])
+
+    def __getstate__(self):
+        # Map the cache again in the DataLoader workers instead of pickling the blocks
+        state = self.__dict__.copy()
+        del state["examples"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.examples = load_tokens_cache(self.cached_features_file)
 
 
 class LineByLineTextDataset(Dataset):
+    cache_prefix = "_cached_lines_"
+
     def __init__(self, tokenizer: PreTrainedTokenizer, args, file_path: str, block_size=512):
         assert os.path.isfile(file_path)
-        # Here, we do not cache the features, operating under the assumption
-        # that we will soon use fast multithreaded tokenizers from the
-        # `tokenizers` repo everywhere =)
-        logger.info("Creating features from dataset file at %s", file_path)
 
+        directory, filename = os.path.split(file_path)
+        self.cached_features_file = os.path.join(
+            directory,
+            args.model_type + self.cache_prefix + str(block_size) + "_" + filename + "_" + cache_key(tokenizer, file_path) + ".bin",
+        )
+
+        if os.path.exists(self.cached_features_file) and not args.overwrite_cache:
+            logger.info("Loading features from cached file %s", self.cached_features_file)
+        else:
+            logger.info("Creating features from dataset file at %s", file_path)
+
+            examples = self._create_examples(tokenizer, args, file_path, block_size)
+
+            logger.info("Saving features into cached file %s", self.cached_features_file)
+            write_lines_cache(self.cached_features_file, examples, token_dtype(tokenizer))
+
+        self._load_cache()
+
+    def _create_examples(self, tokenizer: PreTrainedTokenizer, args, file_path: str, block_size: int) -> List[List[int]]:
         with open(file_path, encoding="utf-8") as f:
             lines = [line for line in f.read().splitlines() if (len(line) > 0 and not line.isspace())]
 
-        self.examples = tokenizer.batch_encode_plus(lines, add_special_tokens=True, max_length=block_size)["input_ids"]
+        return tokenizer.batch_encode_plus(lines, add_special_tokens=True, max_length=block_size)["input_ids"]
+
+    def _load_cache(self):
+        self.offsets, self.tokens = load_lines_cache(self.cached_features_file)
+        # Number of tokens of every example, to group them by length
+        self.lengths = np.diff(self.offsets)
 
     def __len__(self):
-        return len(self.examples)
+        return len(self.lengths)
 
     def __getitem__(self, i):
-        return torch.tensor(self.examples[i], dtype=torch.long)
+        # View of the memory-mapped line, converted to long ids by `as_token_ids` when collated
+        return torch.from_numpy(self.tokens[self.offsets[i] : self.offsets[i + 1]])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ("offsets", "tokens", "lengths"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load_cache()
+
+
+def document_separator_id(tokenizer: PreTrainedTokenizer) -> int:
+    """ Id of the token ending the packed documents: <|endoftext|> of GPT-2, the end of sequence or separator token. """
+    return tokenizer.eos_token_id if tokenizer._eos_token is not None else tokenizer.sep_token_id
+
+
+def pack_documents(lengths: List[int], capacity: int) -> List[List[int]]:
+    """ Pack the documents into as few blocks of `capacity` tokens as possible.
+
+    Best fit decreasing: the longest documents are placed first, each into the fullest block it fits in.
+
+    :return: indices of the documents of every block
+    """
+    blocks = []
+    # (free space, block index) of the blocks which are not full, sorted
+    free_spaces = []
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        k = bisect.bisect_left(free_spaces, (lengths[i], -1))
+        if k < len(free_spaces):
+            free_space, block = free_spaces.pop(k)
+            blocks[block].append(i)
+        else:
+            free_space, block = capacity, len(blocks)
+            blocks.append([i])
+        free_space -= lengths[i]
+        if free_space > 0:
+            bisect.insort(free_spaces, (free_space, block))
+    return blocks
+
+
+class PackedTextDataset(LineByLineTextDataset):
+    """ Whole documents packed into blocks of `block_size` tokens, each document ended by the separator token.
+
+    The documents are separated by <|endoftext|> in the file or, without it, by empty lines.
+    Only the documents longer than a block are split.
+    """
+
+    cache_prefix = "_cached_packed_"
+
+    def _create_examples(self, tokenizer: PreTrainedTokenizer, args, file_path: str, block_size: int) -> List[List[int]]:
+        block_size = block_size - (tokenizer.max_len - tokenizer.max_len_single_sentence)
+
+        with open(file_path, encoding="utf-8") as f:
+            text = f.read()
+        if DOCUMENT_SEPARATOR in text:
+            documents = text.split(DOCUMENT_SEPARATOR)
+        else:
+            documents = re.split(r"\n\s*\n", text)
+        documents = [document.strip() for document in documents if document.strip()]
+
+        separator_id = document_separator_id(tokenizer)
+        pieces = []
+        for ids in tokenize_documents(tokenizer, documents, args.preprocessing_num_workers):
+            ids.append(separator_id)
+            pieces.extend(ids[i : i + block_size] for i in range(0, len(ids), block_size))
+
+        blocks = pack_documents([len(piece) for piece in pieces], block_size)
+        num_tokens = sum(map(len, pieces))
+        logger.info(
+            "  Packed %d documents into %d blocks, %.1f%% full",
+            len(documents),
+            len(blocks),
+            100.0 * num_tokens / max(len(blocks) * block_size, 1),
+        )
+        return [
+            tokenizer.build_inputs_with_special_tokens([token_id for i in block for token_id in pieces[i]])
+            for block in blocks
+        ]
+
+
+def packed_document_inputs(
+    inputs: torch.Tensor, separator_id: int, reset_position_ids: bool, mask_attention: bool
+) -> Dict[str, torch.Tensor]:
+    """ Position ids starting over at every document of the packed blocks and the attention mask
+    restricting the tokens to their document, see --reset_position_ids and --mask_cross_document_attention. """
+    model_inputs = {}
+    if not (reset_position_ids or mask_attention):
+        return model_inputs
+    # Tokens following the separator start a new document
+    starts = torch.zeros_like(inputs, dtype=torch.bool)
+    starts[:, 1:] = inputs[:, :-1] == separator_id
+    if reset_position_ids:
+        positions = torch.arange(inputs.size(1)).expand_as(inputs)
+        document_starts = torch.where(starts, positions, torch.zeros_like(positions)).cummax(dim=1)[0]
+        model_inputs["position_ids"] = positions - document_starts
+    if mask_attention:
+        documents = starts.long().cumsum(dim=1)
+        model_inputs["attention_mask"] = (documents.unsqueeze(2) == documents.unsqueeze(1)).long()
+    return model_inputs
+
+
+class LengthGroupedBatchSampler(Sampler):
+    """ Batches of the examples of similar lengths, so less of the batch is padding.
+
+    Every epoch the shuffled examples are split into groups of `group_batches` batches of all the processes.
+    The examples of a group are sorted by length and cut into batches, and then all the batches are shuffled.
+    The processes take every `num_replicas`-th example of the same sorted batch, so they step through
+    examples of similar lengths together. The order only depends on the seed and the epoch.
+    """
+
+    def __init__(
+        self,
+        lengths: np.ndarray,
+        batch_size: int,
+        num_replicas: int = 1,
+        rank: int = 0,
+        seed: int = 0,
+        group_batches: int = 50,
+        drop_last: bool = False,
+    ):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.group_batches = group_batches
+        self.drop_last = drop_last
+        self.epoch = 0
+
+        global_batch_size = batch_size * num_replicas
+        if drop_last:
+            self.num_batches = len(lengths) // global_batch_size
+        else:
+            self.num_batches = math.ceil(len(lengths) / global_batch_size)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(len(self.lengths), generator=generator).tolist()
+        # Repeat the first examples for the last batch to be full, like `DistributedSampler`
+        global_batch_size = self.batch_size * self.num_replicas
+        total_size = self.num_batches * global_batch_size
+        if indices:
+            indices = (indices * math.ceil(total_size / len(indices)))[:total_size]
+
+        group_size = global_batch_size * self.group_batches
+        batches = []
+        for start in range(0, total_size, group_size):
+            group = sorted(indices[start : start + group_size], key=lambda i: self.lengths[i], reverse=True)
+            batches.extend(group[i : i + global_batch_size] for i in range(0, len(group), global_batch_size))
+
+        for i in torch.randperm(len(batches), generator=generator).tolist():
+            yield batches[i][self.rank :: self.num_replicas]
+
+    def __len__(self):
+        return self.num_batches
+
+
+def padding_ratio(lengths: np.ndarray, batches: List[List[int]]) -> float:
+    """ Share of the pad tokens in the batches padded to their longest example. """
+    tokens, padded = 0, 0
+    for batch in batches:
+        batch_lengths = lengths[batch]
+        tokens += int(batch_lengths.sum())
+        padded += int(batch_lengths.max()) * len(batch)
+    return 1 - tokens / padded if padded else 0.0
 
 
 def load_and_cache_examples(args, tokenizer, evaluate=False):
     file_path = args.eval_data_file if evaluate else args.train_data_file
-    if args.line_by_line:
+    if args.packing:
+        return PackedTextDataset(tokenizer, args, file_path=file_path, block_size=args.block_size)
+    elif args.line_by_line:
         return LineByLineTextDataset(tokenizer, args, file_path=file_path, block_size=args.block_size)
     else:
         return TextDataset(tokenizer, args, file_path=file_path, block_size=args.block_size)
@@ -176,16 +576,80 @@ def _rotate_checkpoints(args, checkpoint_prefix="checkpoint", use_mtime=False) -
         shutil.rmtree(checkpoint)
 
 
-def mask_tokens(inputs: torch.Tensor, tokenizer: PreTrainedTokenizer, args) -> Tuple[torch.Tensor, torch.Tensor]:
-    """ Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original. """
+class DataCollatorForLanguageModeling:
+    """ Pad the examples into a batch and prepare the model inputs and labels.
+
+    Built once per tokenizer: the special tokens are looked up in a table of the whole vocabulary,
+    so masking is a few tensor ops on the batch. Only keeps tensors and numbers, so it can be pickled
+    to the DataLoader workers.
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizer, args):
+        self.mlm = args.mlm
+        self.mlm_probability = args.mlm_probability
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer._pad_token is not None else None
+        self.vocab_size = len(tokenizer)
+        self.separator_id = document_separator_id(tokenizer)
+        self.reset_position_ids = args.reset_position_ids
+        self.mask_cross_document_attention = args.mask_cross_document_attention
+
+        if self.mlm:
+            if tokenizer.mask_token is None:
+                raise ValueError(
+                    "This tokenizer does not have a mask token which is necessary for masked language modeling. Remove the --mlm flag if you want to use this tokenizer."
+                )
+            self.mask_token_id = tokenizer.convert_tokens_to_ids(tokenizer.mask_token)
+            # The special tokens mask of the vocabulary, the same as of every sequence
+            self.special_tokens_table = torch.tensor(
+                tokenizer.get_special_tokens_mask(list(range(self.vocab_size)), already_has_special_tokens=True),
+                dtype=torch.bool,
+            )
 
-    if tokenizer.mask_token is None:
-        raise ValueError(
-            "This tokenizer does not have a mask token which is necessary for masked language modeling. Remove the --mlm flag if you want to use this tokenizer."
+    def __call__(self, examples: List[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor, Dict[str, torch.Tensor]]:
+        batch = self.pad(examples)
+        document_inputs = packed_document_inputs(
+            batch, self.separator_id, self.reset_position_ids, self.mask_cross_document_attention
         )
+        inputs, labels = self.mask_tokens(batch) if self.mlm else (batch, batch)
+        return inputs, labels, document_inputs
 
+    def pad(self, examples: List[torch.Tensor]) -> torch.Tensor:
+        examples = [as_token_ids(example) for example in examples]
+        if self.pad_token_id is None:
+            return pad_sequence(examples, batch_first=True)
+        return pad_sequence(examples, batch_first=True, padding_value=self.pad_token_id)
+
+    def mask_tokens(self, inputs: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """ Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original. """
+        labels = inputs.clone()
+        # We sample a few tokens in each sequence for masked-LM training (with probability args.mlm_probability defaults to 0.15 in Bert/RoBERTa)
+        probability_matrix = torch.full(labels.shape, self.mlm_probability)
+        probability_matrix.masked_fill_(self.special_tokens_table[labels], value=0.0)
+        if self.pad_token_id is not None:
+            padding_mask = labels.eq(self.pad_token_id)
+            probability_matrix.masked_fill_(padding_mask, value=0.0)
+        masked_indices = torch.bernoulli(probability_matrix).bool()
+        labels[~masked_indices] = -100  # We only compute loss on masked tokens
+
+        # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
+        indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8)).bool() & masked_indices
+        inputs[indices_replaced] = self.mask_token_id
+
+        # 10% of the time, we replace masked input tokens with random word
+        indices_random = torch.bernoulli(torch.full(labels.shape, 0.5)).bool() & masked_indices & ~indices_replaced
+        random_words = torch.randint(self.vocab_size, labels.shape, dtype=torch.long)
+        inputs[indices_random] = random_words[indices_random]
+
+        # The rest of the time (10% of the time) we keep the masked input tokens unchanged
+        return inputs, labels
+
+
+def mask_tokens_row_by_row(
+    inputs: torch.Tensor, tokenizer: PreTrainedTokenizer, args
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """ `DataCollatorForLanguageModeling.mask_tokens` as it was before the special tokens lookup table,
+    with the special tokens mask computed row by row. Only kept as the reference of `benchmark_masking`. """
     labels = inputs.clone()
-    # We sample a few tokens in each sequence for masked-LM training (with probability args.mlm_probability defaults to 0.15 in Bert/RoBERTa)
     probability_matrix = torch.full(labels.shape, args.mlm_probability)
     special_tokens_mask = [
         tokenizer.get_special_tokens_mask(val, already_has_special_tokens=True) for val in labels.tolist()
@@ -195,21 +659,131 @@ def mask_tokens(inputs: torch.Tensor, tokenizer: PreTrainedTokenizer, args) -> T
         padding_mask = labels.eq(tokenizer.pad_token_id)
         probability_matrix.masked_fill_(padding_mask, value=0.0)
     masked_indices = torch.bernoulli(probability_matrix).bool()
-    labels[~masked_indices] = -100  # We only compute loss on masked tokens
+    labels[~masked_indices] = -100
 
-    # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
     indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8)).bool() & masked_indices
     inputs[indices_replaced] = tokenizer.convert_tokens_to_ids(tokenizer.mask_token)
 
-    # 10% of the time, we replace masked input tokens with random word
     indices_random = torch.bernoulli(torch.full(labels.shape, 0.5)).bool() & masked_indices & ~indices_replaced
     random_words = torch.randint(len(tokenizer), labels.shape, dtype=torch.long)
     inputs[indices_random] = random_words[indices_random]
-
-    # The rest of the time (10% of the time) we keep the masked input tokens unchanged
     return inputs, labels
 
 
+def benchmark_masking(args, tokenizer: PreTrainedTokenizer, steps: int = 100) -> None:
+    """ Log the time per step to mask the train batches, with the special tokens mask computed row by row
+    with `get_special_tokens_mask` as before `DataCollatorForLanguageModeling`, and with the collator. """
+    train_dataset = load_and_cache_examples(args, tokenizer, evaluate=False)
+    collator = DataCollatorForLanguageModeling(tokenizer, args)
+    batch_size = args.per_gpu_train_batch_size
+    batches = [
+        collator.pad([train_dataset[i % len(train_dataset)] for i in range(start, start + batch_size)])
+        for start in range(0, steps * batch_size, batch_size)
+    ]
+
+    start = time.perf_counter()
+    for batch in batches:
+        special_tokens_mask = [
+            tokenizer.get_special_tokens_mask(val, already_has_special_tokens=True) for val in batch.tolist()
+        ]
+        torch.tensor(special_tokens_mask, dtype=torch.bool)
+    row_by_row = (time.perf_counter() - start) / steps
+    start = time.perf_counter()
+    for batch in batches:
+        collator.special_tokens_table[batch]
+    table = (time.perf_counter() - start) / steps
+    start = time.perf_counter()
+    for batch in batches:
+        mask_tokens_row_by_row(batch.clone(), tokenizer, args)
+    masking_before = (time.perf_counter() - start) / steps
+    start = time.perf_counter()
+    for batch in batches:
+        collator.mask_tokens(batch.clone())
+    masking = (time.perf_counter() - start) / steps
+
+    logger.info("  Batches of %d x %d tokens", batch_size, batches[0].size(1))
+    logger.info("  Special tokens mask row by row: %.3f ms per step", row_by_row * 1000)
+    logger.info("  Special tokens mask from the table: %.3f ms per step", table * 1000)
+    logger.info("  Masking: %.3f ms per step, %.3f ms before", masking * 1000, masking_before * 1000)
+
+
+class DevicePrefetcher:
+    """ Iterate the batches of the DataLoader already moved to the device.
+
+    Up to `depth` batches are copied ahead of the training step with non-blocking transfers,
+    on a side CUDA stream, so the copies overlap with the computation. `wait_time` counts the
+    seconds spent waiting for the DataLoader, which is when the step is starved of data.
+    """
+
+    def __init__(self, dataloader: DataLoader, device: torch.device, depth: int = 2):
+        self.dataloader = dataloader
+        self.device = device
+        self.depth = max(depth, 1)
+        self.wait_time = 0.0
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def _to_device(self, batch):
+        if isinstance(batch, torch.Tensor):
+            return batch.to(self.device, non_blocking=True)
+        if isinstance(batch, dict):
+            return {name: self._to_device(value) for name, value in batch.items()}
+        return type(batch)(self._to_device(value) for value in batch)
+
+    def _tensors(self, batch):
+        if isinstance(batch, torch.Tensor):
+            return [batch]
+        values = batch.values() if isinstance(batch, dict) else batch
+        return [tensor for value in values for tensor in self._tensors(value)]
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        iterator = iter(self.dataloader)
+        queue = collections.deque()
+
+        def fetch():
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.wait_time += time.perf_counter() - start
+            if stream is None:
+                queue.append((self._to_device(batch), None))
+                return
+            with torch.cuda.stream(stream):
+                batch = self._to_device(batch)
+                event = torch.cuda.Event()
+                event.record(stream)
+            queue.append((batch, event))
+
+        for _ in range(self.depth):
+            fetch()
+        while queue:
+            batch, event = queue.popleft()
+            if event is not None:
+                torch.cuda.current_stream(self.device).wait_event(event)
+                # The memory allocated on the side stream is now used by the current one
+                for tensor in self._tensors(batch):
+                    tensor.record_stream(torch.cuda.current_stream(self.device))
+            fetch()
+            yield batch
+
+
+def dataloader_kwargs(args, persistent_workers: bool = False) -> Dict:
+    """ Worker processes, pinned memory and prefetching of the DataLoader, see --dataloader_num_workers. """
+    kwargs = {
+        "num_workers": args.dataloader_num_workers,
+        "pin_memory": not args.no_pin_memory and args.device.type == "cuda",
+    }
+    if args.dataloader_num_workers > 0:
+        kwargs["prefetch_factor"] = args.prefetch_depth
+        kwargs["persistent_workers"] = persistent_workers
+    return kwargs
+
+
 def train(args, train_dataset, model: PreTrainedModel, tokenizer: PreTrainedTokenizer) -> Tuple[int, float]:
     """ Train the model """
     if args.local_rank in [-1, 0]:
@@ -217,15 +791,39 @@ def train(args, train_dataset, model: PreTrainedModel, tokenizer: PreTrainedToke
 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
 
-    def collate(examples: List[torch.Tensor]):
-        if tokenizer._pad_token is None:
-            return pad_sequence(examples, batch_first=True)
-        return pad_sequence(examples, batch_first=True, padding_value=tokenizer.pad_token_id)
+    collate = DataCollatorForLanguageModeling(tokenizer, args)
 
-    train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
-    train_dataloader = DataLoader(
-        train_dataset, sampler=train_sampler, batch_size=args.train_batch_size, collate_fn=collate
-    )
+    if args.group_by_length and hasattr(train_dataset, "lengths"):
+        train_sampler = LengthGroupedBatchSampler(
+            train_dataset.lengths,
+            args.train_batch_size,
+            num_replicas=torch.distributed.get_world_size() if args.local_rank != -1 else 1,
+            rank=torch.distributed.get_rank() if args.local_rank != -1 else 0,
+            seed=args.seed,
+        )
+        train_dataloader = DataLoader(
+            train_dataset,
+            batch_sampler=train_sampler,
+            collate_fn=collate,
+            **dataloader_kwargs(args, persistent_workers=True),
+        )
+        random_batches = torch.randperm(len(train_dataset), generator=torch.Generator().manual_seed(args.seed))
+        random_batches = random_batches.split(args.train_batch_size)
+        logger.info(
+            "  Padding ratio = %.3f, %.3f with random batches",
+            padding_ratio(train_dataset.lengths, list(train_sampler)),
+            padding_ratio(train_dataset.lengths, [batch.numpy() for batch in random_batches]),
+        )
+    else:
+        train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
+        train_dataloader = DataLoader(
+            train_dataset,
+            sampler=train_sampler,
+            batch_size=args.train_batch_size,
+            collate_fn=collate,
+            **dataloader_kwargs(args, persistent_workers=True),
+        )
+    train_prefetcher = DevicePrefetcher(train_dataloader, args.device, args.prefetch_depth)
 
     if args.max_steps > 0:
         t_total = args.max_steps
@@ -311,6 +909,7 @@ def train(args, train_dataset, model: PreTrainedModel, tokenizer: PreTrainedToke
             logger.info("  Starting fine-tuning.")
 
     tr_loss, logging_loss = 0.0, 0.0
+    logging_wait_time = 0.0
 
     model.zero_grad()
     train_iterator = trange(
@@ -318,23 +917,24 @@ def train(args, train_dataset, model: PreTrainedModel, tokenizer: PreTrainedToke
     )
     set_seed(args)  # Added here for reproducibility
     for epoch in train_iterator:
-        epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=args.local_rank not in [-1, 0])
+        epoch_iterator = tqdm(train_prefetcher, desc="Iteration", disable=args.local_rank not in [-1, 0])
 
-        if args.local_rank != -1:
+        if hasattr(train_sampler, "set_epoch"):
             train_sampler.set_epoch(epoch)
 
-        for step, batch in enumerate(epoch_iterator):
+        epoch_start, epoch_wait_time = time.perf_counter(), train_prefetcher.wait_time
+        for step, (inputs, labels, document_inputs) in enumerate(epoch_iterator):
 
             # Skip past any already trained steps if resuming training
             if steps_trained_in_current_epoch > 0:
                 steps_trained_in_current_epoch -= 1
                 continue
 
-            inputs, labels = mask_tokens(batch, tokenizer, args) if args.mlm else (batch, batch)
-            inputs = inputs.to(args.device)
-            labels = labels.to(args.device)
             model.train()
-            outputs = model(inputs, masked_lm_labels=labels) if args.mlm else model(inputs, labels=labels)
+            if args.mlm:
+                outputs = model(inputs, masked_lm_labels=labels, **document_inputs)
+            else:
+                outputs = model(inputs, labels=labels, **document_inputs)
             loss = outputs[0]  # model outputs are always tuple in transformers (see doc)
 
             if args.n_gpu > 1:
@@ -369,7 +969,13 @@ def train(args, train_dataset, model: PreTrainedModel, tokenizer: PreTrainedToke
                             tb_writer.add_scalar("eval_{}".format(key), value, global_step)
                     tb_writer.add_scalar("lr", scheduler.get_lr()[0], global_step)
                     tb_writer.add_scalar("loss", (tr_loss - logging_loss) / args.logging_steps, global_step)
+                    tb_writer.add_scalar(
+                        "data_wait_time",
+                        (train_prefetcher.wait_time - logging_wait_time) / args.logging_steps,
+                        global_step,
+                    )
                     logging_loss = tr_loss
+                    logging_wait_time = train_prefetcher.wait_time
 
                 if args.local_rank in [-1, 0] and args.save_steps > 0 and global_step % args.save_steps == 0:
                     checkpoint_prefix = "checkpoint"
@@ -394,6 +1000,12 @@ def train(args, train_dataset, model: PreTrainedModel, tokenizer: PreTrainedToke
             if args.max_steps > 0 and global_step > args.max_steps:
                 epoch_iterator.close()
                 break
+        logger.info(
+            "  Epoch %d: waited %.1f s for the data in %.1f s",
+            epoch,
+            train_prefetcher.wait_time - epoch_wait_time,
+            time.perf_counter() - epoch_start,
+        )
         if args.max_steps > 0 and global_step > args.max_steps:
             train_iterator.close()
             break
@@ -416,15 +1028,12 @@ def evaluate(args, model: PreTrainedModel, tokenizer: PreTrainedTokenizer, prefi
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
     # Note that DistributedSampler samples randomly
 
-    def collate(examples: List[torch.Tensor]):
-        if tokenizer._pad_token is None:
-            return pad_sequence(examples, batch_first=True)
-        return pad_sequence(examples, batch_first=True, padding_value=tokenizer.pad_token_id)
-
+    collate = DataCollatorForLanguageModeling(tokenizer, args)
     eval_sampler = SequentialSampler(eval_dataset)
     eval_dataloader = DataLoader(
-        eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size, collate_fn=collate
+        eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size, collate_fn=collate, **dataloader_kwargs(args)
     )
+    eval_prefetcher = DevicePrefetcher(eval_dataloader, args.device, args.prefetch_depth)
 
     # multi-gpu evaluate
     if args.n_gpu > 1:
@@ -438,18 +1047,19 @@ def evaluate(args, model: PreTrainedModel, tokenizer: PreTrainedTokenizer, prefi
     nb_eval_steps = 0
     model.eval()
 
-    for batch in tqdm(eval_dataloader, desc="Evaluating"):
-        inputs, labels = mask_tokens(batch, tokenizer, args) if args.mlm else (batch, batch)
-        inputs = inputs.to(args.device)
-        labels = labels.to(args.device)
-
+    eval_start = time.perf_counter()
+    for inputs, labels, document_inputs in tqdm(eval_prefetcher, desc="Evaluating"):
         with torch.no_grad():
-            outputs = model(inputs, masked_lm_labels=labels) if args.mlm else model(inputs, labels=labels)
+            if args.mlm:
+                outputs = model(inputs, masked_lm_labels=labels, **document_inputs)
+            else:
+                outputs = model(inputs, labels=labels, **document_inputs)
             lm_loss = outputs[0]
             eval_loss += lm_loss.mean().item()
         nb_eval_steps += 1
 
     eval_loss = eval_loss / nb_eval_steps
+    logger.info("  Waited %.1f s for the data in %.1f s", eval_prefetcher.wait_time, time.perf_counter() - eval_start)
     perplexity = torch.exp(torch.tensor(eval_loss))
 
     result = {"perplexity": perplexity}
@@ -493,6 +1103,43 @@ def main():
         action="store_true",
         help="Whether distinct lines of text in the dataset are to be handled as distinct sequences.",
     )
+    parser.add_argument(
+        "--preprocessing_num_workers",
+        default=None,
+        type=int,
+        help="Number of processes tokenizing the dataset. Defaults to the number of CPU cores.",
+    )
+    parser.add_argument(
+        "--benchmark_tokenization",
+        action="store_true",
+        help="Only measure the time to tokenize the train data file with an increasing number of processes.",
+    )
+    parser.add_argument(
+        "--packing",
+        action="store_true",
+        help="Pack whole documents, separated by <|endoftext|> or empty lines, into the blocks of block_size tokens.",
+    )
+    parser.add_argument(
+        "--reset_position_ids",
+        action="store_true",
+        help="Start the position ids over at every document of the packed blocks. Only used with --packing.",
+    )
+    parser.add_argument(
+        "--mask_cross_document_attention",
+        action="store_true",
+        help="Restrict the attention to the document of every token of the packed blocks. Only used with --packing "
+        "and the models taking 3D attention masks (BERT-like, --mlm).",
+    )
+    parser.add_argument(
+        "--group_by_length",
+        action="store_true",
+        help="Batch the lines of similar lengths together to pad less. Only used with --line_by_line or --packing.",
+    )
+    parser.add_argument(
+        "--benchmark_masking",
+        action="store_true",
+        help="Only measure the time per step to mask the train batches for --mlm, before and after the lookup table.",
+    )
     parser.add_argument(
         "--should_continue", action="store_true", help="Whether to continue from latest checkpoint in output_dir"
     )
@@ -581,6 +1228,19 @@ def main():
         help="Evaluate all checkpoints starting with the same prefix as model_name_or_path ending and ending with step number",
     )
     parser.add_argument("--no_cuda", action="store_true", help="Avoid using CUDA when available")
+    parser.add_argument(
+        "--dataloader_num_workers",
+        default=2,
+        type=int,
+        help="Number of processes collating and masking the batches, 0 to prepare them in the main process.",
+    )
+    parser.add_argument(
+        "--prefetch_depth",
+        default=2,
+        type=int,
+        help="Number of batches prepared ahead by every DataLoader worker and copied to the device ahead of the step.",
+    )
+    parser.add_argument("--no_pin_memory", action="store_true", help="Avoid pinning the memory of the batches")
     parser.add_argument(
         "--overwrite_output_dir", action="store_true", help="Overwrite the content of the output directory"
     )
@@ -605,6 +1265,8 @@ def main():
     parser.add_argument("--server_ip", type=str, default="", help="For distant debugging.")
     parser.add_argument("--server_port", type=str, default="", help="For distant debugging.")
     args = parser.parse_args()
+    if args.preprocessing_num_workers is None:
+        args.preprocessing_num_workers = os.cpu_count()
 
     if args.model_type in ["bert", "roberta", "distilbert", "camembert"] and not args.mlm:
         raise ValueError(
@@ -616,6 +1278,14 @@ def main():
             "Cannot do evaluation without an evaluation data file. Either supply a file to --eval_data_file "
             "or remove the --do_eval argument."
         )
+    if (args.reset_position_ids or args.mask_cross_document_attention) and not args.packing:
+        raise ValueError("--reset_position_ids and --mask_cross_document_attention need the --packing flag.")
+    if args.benchmark_masking and not args.mlm:
+        raise ValueError("--benchmark_masking measures the masked language modeling, it needs the --mlm flag.")
+    if args.mask_cross_document_attention and not args.mlm:
+        raise ValueError(
+            "GPT and GPT-2 only take 2D attention masks, --mask_cross_document_attention can only be used with --mlm."
+        )
     if args.should_continue:
         sorted_checkpoints = _sorted_checkpoints(args)
         if len(sorted_checkpoints) == 0:
@@ -700,12 +1370,20 @@ def main():
             "and load it from here, using --tokenizer_name"
         )
 
+    if args.benchmark_tokenization:
+        benchmark_tokenization(tokenizer, args.train_data_file, args.preprocessing_num_workers)
+        return {}
+
     if args.block_size <= 0:
         args.block_size = tokenizer.max_len
         # Our input block size will be the max possible for the model
     else:
         args.block_size = min(args.block_size, tokenizer.max_len)
 
+    if args.benchmark_masking:
+        benchmark_masking(args, tokenizer)
+        return {}
+
     if args.model_name_or_path:
         model = AutoModelWithLMHead.from_pretrained(
             args.model_name_or_path,